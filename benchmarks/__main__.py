@@ -0,0 +1,44 @@
+import argparse
+import datetime as dt
+import json
+import platform
+import sys
+
+from . import alarm_records, due_alarms, store
+
+SUITES = {
+    'store': store.run,
+    'due_alarms': due_alarms.run,
+    'alarm_records': alarm_records.run,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run remhind benchmarks")
+    parser.add_argument('suites', nargs='*', metavar='suite',
+        help=f"benchmark to run among {', '.join(SUITES)} (default: all)")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+        default=sys.stdout, help="file receiving the JSON report")
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f'unknown benchmark {suite}')
+
+    results = []
+    for suite in args.suites or SUITES:
+        for result in SUITES[suite]():
+            print(f"{result['name']} {result['params']}: {result['metrics']}",
+                file=sys.stderr)
+            results.append(result)
+
+    json.dump({
+            'date': dt.datetime.now(dt.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+            }, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import datetime as dt
+import time
+import tracemalloc
+
+import pytz
+
+from remhind.db import SQLiteDB
+
+START = dt.datetime(2020, 1, 1, tzinfo=pytz.UTC)
+
+
+def fill_alarms(db, count):
+    def alarms():
+        for idx in range(count):
+            date = START + dt.timedelta(seconds=idx)
+            yield (f'event-{idx}', date, date, f'Alarm {idx}', False, 0)
+
+    with db.transaction():
+        db.add_alarms(alarms())
+
+
+def measure(func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+
+def run(count=100_000):
+    db = SQLiteDB()
+    fill_alarms(db, count)
+    end = START + dt.timedelta(seconds=count)
+
+    def fetch():
+        db.get_alarms(START, end)
+
+    def fetch_dates():
+        for alarm in db.get_alarms(START, end):
+            alarm.date, alarm.due_date
+
+    for name, func in [('get_alarms', fetch), ('with dates', fetch_dates)]:
+        func()
+        duration, peak = measure(func)
+        yield {
+            'name': 'alarm_records',
+            'params': {'alarms': count, 'dates': func is fetch_dates},
+            'metrics': {'seconds': duration, 'peak_memory_bytes': peak},
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="cost of fetching alarms from the database")
+    parser.add_argument('--count', type=int, default=100_000)
+    args = parser.parse_args()
+
+    for result in run(args.count):
+        name = 'with dates' if result['params']['dates'] else 'get_alarms'
+        duration = result['metrics']['seconds']
+        peak = result['metrics']['peak_memory_bytes']
+        print(f'{name:>12}: {duration * 1e3:8.1f} ms'
+            f' {peak / 2 ** 20:8.1f} MiB peak for {args.count} alarms')
+
+
+if __name__ == '__main__':
+    main()
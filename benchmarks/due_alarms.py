@@ -0,0 +1,86 @@
+import argparse
+import datetime as dt
+import random
+import statistics
+import time
+
+import pytz
+
+from remhind.db import SQLiteDB, _to_utc_timestamp
+
+START = dt.datetime(2020, 1, 1, tzinfo=pytz.UTC)
+SPAN = dt.timedelta(days=10 * 365)
+
+
+def fill_alarms(db, count, todo_ratio=0.1, seed=0):
+    rng = random.Random(seed)
+    span = int(SPAN.total_seconds() // 60)
+
+    def alarms():
+        for idx in range(count):
+            due_date = START + dt.timedelta(minutes=rng.randrange(span))
+            date = due_date - dt.timedelta(minutes=rng.choice((0, 15, 30)))
+            yield (f'event-{seed}-{idx}', date, due_date, f'Alarm {idx}',
+                rng.random() < todo_ratio, 0)
+
+    with db.transaction():
+        db.add_alarms(alarms())
+
+
+def time_minute_checks(db, checks=200, seed=1):
+    rng = random.Random(seed)
+    span = int(SPAN.total_seconds() // 60)
+    minutes = [START + dt.timedelta(minutes=rng.randrange(span))
+        for _ in range(checks)]
+
+    event_timings = []
+    for minute in minutes:
+        end = minute + dt.timedelta(minutes=1)
+        start = time.perf_counter()
+        db.get_event_alarms(_to_utc_timestamp(minute), _to_utc_timestamp(end))
+        event_timings.append(time.perf_counter() - start)
+
+    todo_timings = []
+    for minute in minutes:
+        end = minute + dt.timedelta(minutes=1)
+        start = time.perf_counter()
+        db.get_due_todos(minute, end)
+        todo_timings.append(time.perf_counter() - start)
+    return statistics.median(event_timings), statistics.median(todo_timings)
+
+
+def run(sizes=(1_000, 10_000, 100_000, 1_000_000), checks=200):
+    db = SQLiteDB()
+    filled = 0
+    for size in sorted(sizes):
+        fill_alarms(db, size - filled, seed=size)
+        filled = size
+        events, todos = time_minute_checks(db, checks)
+        yield {
+            'name': 'due_alarms',
+            'params': {'alarms': size, 'checks': checks},
+            'metrics': {
+                'event_check_seconds': events,
+                'todo_check_seconds': todos,
+                },
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="per-minute alarm check cost by alarms table size")
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--checks', type=int, default=200)
+    args = parser.parse_args()
+
+    for result in run(args.sizes, args.checks):
+        size = result['params']['alarms']
+        events = result['metrics']['event_check_seconds']
+        todos = result['metrics']['todo_check_seconds']
+        print(f'{size:>10} alarms: {events * 1e6:10.1f} µs events'
+            f' {todos * 1e6:10.1f} µs todos per check')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import datetime as dt
+import json
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+
+from remhind.db import LOCAL_TZ
+from remhind.events import CalendarStore
+
+from .vdir import generate_vdir, make_calendar, make_component
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run(calendars=4, files=250, components=1, jobs=None, changes=50,
+        minutes=24 * 60):
+    params = {
+        'calendars': calendars, 'files': files, 'components': components,
+        'jobs': jobs,
+        }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+        sources = generate_vdir(
+            tmp_path / 'vdir', calendars, files, components)
+        db_path = tmp_path / 'remhind.db'
+
+        duration, store = _timed(
+            CalendarStore, sources, db_path, workers=jobs)
+        yield {
+            'name': 'store_init_cold', 'params': params,
+            'metrics': {'seconds': duration},
+            }
+        store.events.db.close()
+
+        duration, store = _timed(
+            CalendarStore, sources, db_path, workers=jobs)
+        yield {
+            'name': 'store_init_warm', 'params': params,
+            'metrics': {'seconds': duration},
+            }
+
+        rng = random.Random(0)
+        cal_path = pathlib.Path(sources[0]['path'])
+        start = dt.datetime.now(dt.timezone.utc).replace(
+            second=0, microsecond=0)
+        new_files = []
+        for idx in range(changes):
+            ics = cal_path / f'new-{idx}.ics'
+            ics.write_text(make_calendar([make_component(
+                            f'new-{idx}@remhind', 'rrule', start, rng)]))
+            new_files.append(ics)
+
+        def modify(ics):
+            ics.write_text(
+                ics.read_text().replace('SUMMARY:', 'SUMMARY:Modified '))
+
+        for name, prepare, method in [
+                ('store_add_file', None, store.add_file),
+                ('store_modify_file', modify, store.modify_file),
+                ('store_remove_file', None, store.remove_file)]:
+            timings = []
+            for ics in new_files:
+                if prepare is not None:
+                    prepare(ics)
+                timings.append(_timed(method, ics)[0])
+            yield {
+                'name': name, 'params': dict(params, changes=changes),
+                'metrics': {
+                    'mean_seconds': statistics.mean(timings),
+                    'max_seconds': max(timings),
+                    },
+                }
+
+        now = dt.datetime.now(LOCAL_TZ).replace(second=0, microsecond=0)
+        timings, alarms = [], 0
+        for minute in range(minutes):
+            date = now + dt.timedelta(minutes=minute)
+            duration, due_alarms = _timed(store.events.get_due_alarms, date)
+            timings.append(duration)
+            alarms += len(due_alarms)
+        yield {
+            'name': 'get_due_alarms', 'params': dict(params, minutes=minutes),
+            'metrics': {
+                'mean_seconds': statistics.mean(timings),
+                'max_seconds': max(timings),
+                'alarms': alarms,
+                },
+            }
+        store.events.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time CalendarStore operations on a synthetic vdir")
+    parser.add_argument('--calendars', type=int, default=4)
+    parser.add_argument('--files', type=int, default=250)
+    parser.add_argument('--components', type=int, default=1)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    for result in run(
+            args.calendars, args.files, args.components, args.jobs):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
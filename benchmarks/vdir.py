@@ -0,0 +1,127 @@
+import argparse
+import datetime as dt
+import pathlib
+import random
+
+KINDS = {
+    'single': 4,
+    'rrule': 3,
+    'vtodo': 2,
+    'multi_valarm': 1,
+    }
+
+VALARM = """BEGIN:VALARM
+TRIGGER:-PT{minutes}M
+ACTION:DISPLAY
+DESCRIPTION:{summary} in {minutes} minutes
+END:VALARM
+"""
+
+VEVENT = """BEGIN:VEVENT
+UID:{uid}
+DTSTAMP:{stamp}
+DTSTART:{start}
+DTEND:{end}
+SUMMARY:{summary}
+{extra}{alarms}END:VEVENT
+"""
+
+VTODO = """BEGIN:VTODO
+UID:{uid}
+DTSTAMP:{stamp}
+DUE:{start}
+SUMMARY:{summary}
+STATUS:NEEDS-ACTION
+{alarms}END:VTODO
+"""
+
+RRULES = [
+    'FREQ=DAILY',
+    'FREQ=WEEKLY;BYDAY=MO,WE,FR',
+    'FREQ=MONTHLY;BYMONTHDAY=1,15',
+    'FREQ=HOURLY;INTERVAL=4',
+    ]
+
+
+def _format(date):
+    return date.strftime('%Y%m%dT%H%M%SZ')
+
+
+def make_component(uid, kind, start, rng):
+    summary = f'{kind.replace("_", " ").capitalize()} {uid}'
+    if kind == 'multi_valarm':
+        alarms = ''.join(
+            VALARM.format(minutes=m, summary=summary)
+            for m in rng.sample([5, 10, 15, 30, 60, 120], 3))
+    else:
+        alarms = VALARM.format(
+            minutes=rng.choice([5, 15, 30]), summary=summary)
+
+    if kind == 'vtodo':
+        return VTODO.format(
+            uid=uid, stamp=_format(start), start=_format(start),
+            summary=summary, alarms=alarms)
+    extra = f'RRULE:{rng.choice(RRULES)}\n' if kind == 'rrule' else ''
+    return VEVENT.format(
+        uid=uid, stamp=_format(start), start=_format(start),
+        end=_format(start + dt.timedelta(hours=1)), summary=summary,
+        extra=extra, alarms=alarms)
+
+
+def make_calendar(components):
+    return ''.join([
+            'BEGIN:VCALENDAR\nVERSION:2.0\n',
+            'PRODID:-//remhind//benchmarks//EN\n',
+            *components,
+            'END:VCALENDAR\n']).replace('\n', '\r\n')
+
+
+def generate_vdir(root, calendars, files, components=1, kinds=None,
+        start=None, span=dt.timedelta(days=30), seed=0):
+    rng = random.Random(seed)
+    kinds = KINDS if kinds is None else kinds
+    if start is None:
+        start = dt.datetime.now(dt.timezone.utc).replace(
+            second=0, microsecond=0)
+    minutes = int(span.total_seconds() // 60)
+    names, weights = list(kinds), list(kinds.values())
+
+    sources = []
+    for cal_idx in range(calendars):
+        cal_path = pathlib.Path(root) / f'calendar-{cal_idx}'
+        cal_path.mkdir(parents=True, exist_ok=True)
+        for file_idx in range(files):
+            cal_components = []
+            for comp_idx in range(components):
+                uid = f'{cal_idx}-{file_idx}-{comp_idx}@remhind'
+                date = start + dt.timedelta(minutes=rng.randrange(minutes))
+                kind, = rng.choices(names, weights)
+                cal_components.append(make_component(uid, kind, date, rng))
+            (cal_path / f'{file_idx}.ics').write_text(
+                make_calendar(cal_components))
+        sources.append({'name': f'Calendar {cal_idx}', 'path': str(cal_path)})
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a synthetic vdir")
+    parser.add_argument('root', type=pathlib.Path)
+    parser.add_argument('--calendars', type=int, default=4)
+    parser.add_argument('--files', type=int, default=250)
+    parser.add_argument('--components', type=int, default=1,
+        help="number of components per file")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sources = generate_vdir(
+        args.root, args.calendars, args.files, args.components,
+        seed=args.seed)
+    print('[calendars]')
+    for idx, source in enumerate(sources):
+        print(f'    [calendars.calendar{idx}]')
+        print(f'    name = "{source["name"]}"')
+        print(f'    path = "{source["path"]}"')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,79 @@
-import asyncio
 import argparse
-import logging
 import pathlib
 
-import gi
-import toml
-from xdg import XDG_CONFIG_HOME, XDG_CACHE_HOME
+from xdg import XDG_CONFIG_HOME, XDG_CACHE_HOME, XDG_RUNTIME_DIR
 
-from .monitor import monitor_calendars
-from .events import check_events, CalendarStore
+from . import control
+from .agenda import agenda, next_alarms, parse_date, ALARM_FORMAT
 
-gi.require_version('Notify', '0.7')
-from gi.repository import Notify  # noqa
 
-
-async def monitor_file_events(args):
-    with args.config.open() as fd:
-        config = toml.load(fd)
-
-    log_level = max(logging.CRITICAL - args.verbose * 10, logging.NOTSET)
-    logging.basicConfig(
-        format='%(asctime)s:%(levelname)s:%(message)s', level=log_level)
-    Notify.init('remhind')
-
-    calendars = CalendarStore(config['calendars'].values(), args.database)
-
-    events_checker = check_events(calendars)
-    calendars_monitor = monitor_calendars(config['calendars'], calendars)
-    await asyncio.gather(events_checker, calendars_monitor)
+def run_daemon(args):
+    # Imported lazily, the agenda commands do not need the notification and
+    # calendar parsing libraries
+    from . import daemon
+    daemon.run(args)
 
 
 def main():
     parser = argparse.ArgumentParser(description="remind event from vdirs")
+    parser.set_defaults(func=run_daemon)
     parser.add_argument('-c', '--config', type=pathlib.Path,
         default=XDG_CONFIG_HOME / 'remhind' / 'config')
     parser.add_argument('-d', '--database', type=pathlib.Path,
         default=XDG_CACHE_HOME / 'remhind.db')
+    parser.add_argument('-s', '--socket', type=pathlib.Path,
+        default=(XDG_RUNTIME_DIR or XDG_CACHE_HOME) / control.SOCKET_NAME,
+        help="control socket of the daemon")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help="number of processes parsing calendars at startup")
+    parser.add_argument('--horizon', type=float, default=None,
+        help="days of recurring events occurences kept in the database")
+    parser.add_argument('--quiet-period', type=float, default=None,
+        help="seconds without changes before a file is indexed again")
+    parser.add_argument('--group-alarms', type=int, default=None,
+        help="alarms due in the same minute above which a single summary"
+            " notification is shown, 0 to never group them")
+    parser.add_argument('--notification-rate', type=float, default=None,
+        help="maximum number of notifications shown per second")
+    parser.add_argument('--stats', action='store_true',
+        help="collect timings of the daemon, dumped on SIGUSR1")
+    parser.add_argument('--metrics-file', type=pathlib.Path, default=None,
+        help="file where timings are periodically written (implies --stats)")
     parser.add_argument('-v', '--verbose', action='count', default=0)
 
-    asyncio.run(monitor_file_events(parser.parse_args()))
+    subparsers = parser.add_subparsers(
+        title="commands", description="without command, run the daemon")
+    agenda_parser = subparsers.add_parser(
+        'agenda', help="list the alarms of a period")
+    agenda_parser.set_defaults(func=agenda)
+    agenda_parser.add_argument('--from', dest='start', type=parse_date,
+        default=None, help="ISO date, defaults to now")
+    agenda_parser.add_argument('--to', dest='end', type=parse_date,
+        default=None, help="ISO date, defaults to a day after --from")
+    next_parser = subparsers.add_parser('next', help="show the next alarms")
+    next_parser.set_defaults(func=next_alarms)
+    next_parser.add_argument('-n', '--count', type=int, default=1)
+    for command_parser in [agenda_parser, next_parser]:
+        command_parser.add_argument('--format', default=ALARM_FORMAT,
+            help="format of the alarms, using the date, due_date, message"
+                " and event fields")
+
+    ctl_parser = subparsers.add_parser(
+        'ctl', help="send a command to the running daemon")
+    ctl_parser.set_defaults(func=control.command)
+    ctl_subparsers = ctl_parser.add_subparsers(dest='command', required=True)
+    rescan_parser = ctl_subparsers.add_parser(
+        'rescan', help="index the changes of a calendar file or directory")
+    rescan_parser.add_argument('path', type=pathlib.Path, nargs='?',
+        help="defaults to all the calendars")
+    ctl_next_parser = ctl_subparsers.add_parser(
+        'next', help="show the next alarms")
+    ctl_next_parser.add_argument('-n', '--count', type=int, default=1)
+    ctl_subparsers.add_parser('stats', help="show the timing statistics")
+    ctl_subparsers.add_parser('flush', help="empty the in-memory caches")
+
+    args = parser.parse_args()
+    args.func(args)
 
 
 if __name__ == '__main__':
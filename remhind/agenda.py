@@ -0,0 +1,66 @@
+import datetime as dt
+import sqlite3
+import sys
+
+from .db import LOCAL_TZ, AlarmTimeline, SQLiteDB
+
+# Only the database is read, neither the calendars nor the heavy modules of
+# the daemon are loaded, so that status bars can poll those commands
+AGENDA_PERIOD = dt.timedelta(days=1)
+ALARM_FORMAT = '{date:%Y-%m-%d %H:%M} {due_date:%H:%M} {message}'
+
+
+def parse_date(value):
+    # Naive dates are in the local time zone
+    return dt.datetime.fromisoformat(value).astimezone(LOCAL_TZ)
+
+
+def get_agenda(db, start, end):
+    timeline = AlarmTimeline(db, window=max(end - start, dt.timedelta()))
+    return timeline.firings(start, end)
+
+
+def get_next_alarms(db, after, count=1):
+    timeline = AlarmTimeline(db)
+    alarms = []
+    while len(alarms) < count:
+        date = timeline.next_date(after)
+        if date is None:
+            break
+        after = date + dt.timedelta(minutes=1)
+        alarms.extend(timeline.firings(date, after))
+    return alarms[:count]
+
+
+def format_alarm(date, alarm, fmt=ALARM_FORMAT):
+    return fmt.format(
+        date=date, due_date=alarm.due_date, message=alarm.message,
+        event=alarm.event)
+
+
+def _open_db(db_path):
+    try:
+        return SQLiteDB(db_path, readonly=True)
+    except sqlite3.Error as exc:
+        sys.exit(f'remhind: could not read {db_path}: {exc}')
+
+
+def agenda(args):
+    start = args.start or dt.datetime.now(LOCAL_TZ)
+    end = args.end or start + AGENDA_PERIOD
+    db = _open_db(args.database)
+    try:
+        for date, alarm in get_agenda(db, start, end):
+            print(format_alarm(date, alarm, args.format))
+    finally:
+        db.close()
+
+
+def next_alarms(args):
+    db = _open_db(args.database)
+    try:
+        for date, alarm in get_next_alarms(
+                db, dt.datetime.now(LOCAL_TZ), args.count):
+            print(format_alarm(date, alarm, args.format))
+    finally:
+        db.close()
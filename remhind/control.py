@@ -0,0 +1,134 @@
+import datetime as dt
+import json
+import logging
+import socket
+import sys
+
+from .agenda import ALARM_FORMAT, get_next_alarms
+from .db import LOCAL_TZ
+from .stats import STATS
+
+# The daemon answers a single JSON request per line on a Unix socket with
+# a JSON object holding either the result or an error message
+SOCKET_NAME = 'remhind.sock'
+
+
+class ControlError(Exception):
+    pass
+
+
+def _alarm_dict(date, alarm):
+    return {
+        'date': date.isoformat(),
+        'due_date': alarm.due_date.isoformat(),
+        'message': alarm.message,
+        'event': alarm.event,
+        }
+
+
+class ControlHandler:
+
+    def __init__(self, calendar_store):
+        self.calendar_store = calendar_store
+        self.commands = {
+            'rescan': self.rescan,
+            'next': self.next_alarms,
+            'stats': self.stats,
+            'flush': self.flush,
+            }
+
+    async def __call__(self, reader, writer):
+        try:
+            line = await reader.readline()
+            response = await self.handle(line)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except Exception:
+            logging.exception('Could not answer control request')
+        finally:
+            writer.close()
+
+    async def handle(self, line):
+        try:
+            request = json.loads(line)
+            command = self.commands[request.pop('command')]
+            return {'result': await command(**request)}
+        except ControlError as exc:
+            return {'error': str(exc)}
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            return {'error': f'invalid request: {exc!r}'}
+        except Exception as exc:
+            logging.exception('Control command failed')
+            return {'error': str(exc)}
+
+    async def rescan(self, path=None):
+        logging.info(f'Rescanning {path or "all calendars"}')
+        try:
+            await self.calendar_store.rescan(path)
+        except ValueError as exc:
+            # The path is outside of the calendars
+            raise ControlError(str(exc)) from exc
+
+    async def next_alarms(self, count=1):
+        firings = await self.calendar_store.run(
+            get_next_alarms, self.calendar_store.store.events.db,
+            dt.datetime.now(LOCAL_TZ), int(count))
+        return [_alarm_dict(date, alarm) for date, alarm in firings]
+
+    async def stats(self):
+        return {'enabled': STATS.enabled, 'summary': STATS.summary()}
+
+    async def flush(self):
+        await self.calendar_store.flush_caches()
+
+
+def is_listening(socket_path):
+    # The socket left by a daemon which was killed refuses connections
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def request(socket_path, command, **params):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError as exc:
+            raise ControlError(
+                f'could not connect to {socket_path}: {exc}') from exc
+        sock.sendall(json.dumps(dict(params, command=command)).encode()
+            + b'\n')
+        with sock.makefile('rb') as fd:
+            response = json.loads(fd.readline() or 'null')
+    if not isinstance(response, dict):
+        raise ControlError('no answer from the daemon')
+    if 'error' in response:
+        raise ControlError(response['error'])
+    return response['result']
+
+
+def command(args):
+    params = {}
+    if args.command == 'rescan' and args.path is not None:
+        params['path'] = str(args.path.expanduser().absolute())
+    elif args.command == 'next':
+        params['count'] = args.count
+    try:
+        result = request(args.socket, args.command, **params)
+    except ControlError as exc:
+        sys.exit(f'remhind: {exc}')
+
+    if args.command == 'next':
+        for alarm in result:
+            print(ALARM_FORMAT.format(
+                    date=dt.datetime.fromisoformat(alarm['date']),
+                    due_date=dt.datetime.fromisoformat(alarm['due_date']),
+                    message=alarm['message'], event=alarm['event']))
+    elif args.command == 'stats':
+        if not result['enabled']:
+            print('statistics are disabled, use --stats')
+        for line in result['summary']:
+            print(line)
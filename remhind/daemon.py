@@ -0,0 +1,106 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import signal
+import sys
+
+import toml
+
+from .control import ControlHandler, is_listening
+from .monitor import monitor_calendars, QUIET_PERIOD
+from .events import check_events, AsyncCalendarStore, HORIZON
+from .notify import Notifier, GROUP_THRESHOLD, MAX_RATE
+from .stats import STATS
+
+METRICS_INTERVAL = 60
+
+# The statistics are requested explicitly, they are logged whatever the
+# verbosity of the daemon
+stats_logger = logging.getLogger('remhind.stats')
+stats_logger.setLevel(logging.INFO)
+
+
+def dump_stats(metrics_file=None):
+    if not STATS.enabled:
+        stats_logger.warning('Statistics are disabled, use --stats')
+        return
+    for line in STATS.summary():
+        stats_logger.info(line)
+    if metrics_file is not None:
+        STATS.write_metrics(metrics_file)
+
+
+async def write_metrics(metrics_file, interval=METRICS_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            STATS.write_metrics(metrics_file)
+        except OSError:
+            logging.exception(f'Could not write metrics to {metrics_file}')
+
+
+def _option(value, default):
+    return default if value is None else value
+
+
+async def serve_control(socket_path, calendar_store):
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    server = await asyncio.start_unix_server(
+        ControlHandler(calendar_store), path=str(socket_path))
+    # Only the user running the daemon may control it, the umask is shared
+    # with the threads of the daemon and is left alone
+    os.chmod(socket_path, 0o600)
+    logging.info(f'Control socket listening on {socket_path}')
+    return server
+
+
+async def monitor_file_events(args):
+    # The control socket of a running daemon would be replaced, and removed
+    # on exit, by this one
+    if is_listening(args.socket):
+        sys.exit(f'remhind: a daemon is already listening on {args.socket}')
+
+    with args.config.open() as fd:
+        config = toml.load(fd)
+
+    log_level = max(logging.CRITICAL - args.verbose * 10, logging.NOTSET)
+    logging.basicConfig(
+        format='%(asctime)s:%(levelname)s:%(message)s', level=log_level)
+    STATS.enabled = args.stats or args.metrics_file is not None
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGUSR1, dump_stats, args.metrics_file)
+
+    horizon = HORIZON
+    if args.horizon is not None:
+        horizon = dt.timedelta(days=args.horizon)
+    calendars = await AsyncCalendarStore.open(
+        config['calendars'].values(), args.database, workers=args.jobs,
+        horizon=horizon)
+
+    notifier = Notifier(
+        group_threshold=_option(args.group_alarms, GROUP_THRESHOLD),
+        max_rate=_option(args.notification_rate, MAX_RATE))
+    notifier.start()
+    control_server = await serve_control(args.socket, calendars)
+
+    events_checker = check_events(calendars, notifier)
+    calendars_monitor = monitor_calendars(
+        config['calendars'], calendars,
+        quiet_period=_option(args.quiet_period, QUIET_PERIOD),
+        config_path=args.config)
+    tasks = [events_checker, calendars_monitor]
+    if args.metrics_file is not None:
+        tasks.append(write_metrics(args.metrics_file))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        control_server.close()
+        await control_server.wait_closed()
+        args.socket.unlink(missing_ok=True)
+        notifier.stop()
+        await calendars.close()
+
+
+def run(args):
+    asyncio.run(monitor_file_events(args))
@@ -0,0 +1,568 @@
+import bisect
+import calendar
+import contextlib
+import datetime as dt
+import logging
+import os
+import pathlib
+import sqlite3
+
+import pytz
+from tzlocal import get_localzone
+
+from .stats import timed
+
+LOCAL_TZ = get_localzone()
+MINUTES_PER_DAY = 24 * 60
+TIMELINE_WINDOW = dt.timedelta(hours=6)
+# Connection settings of file databases, the write-ahead log lets other
+# processes read the database while the daemon writes to it
+DB_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -8 * 1024,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    }
+
+
+def _to_utc_timestamp(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.UTC)
+    return calendar.timegm(dt.timetuple())
+
+
+def _from_utc_timestamp(timestamp, tz=None):
+    if tz is None:
+        tz = LOCAL_TZ
+    return dt.datetime.fromtimestamp(
+        timestamp, tz=pytz.UTC).astimezone(tz)
+
+
+def _minute_of_day(timestamp):
+    return (timestamp % 86400) // 60
+
+
+class Alarm:
+    # Alarms are built for every row fetched, the conversion of their UTC
+    # timestamps to local datetimes is thus only done when needed
+    __slots__ = (
+        'id', 'event', 'message', 'date_timestamp', 'due_timestamp', '_date',
+        '_due_date')
+
+    def __init__(self, id, event, message, date_timestamp, due_timestamp):
+        self.id = id
+        self.event = event
+        self.message = message
+        self.date_timestamp = date_timestamp
+        self.due_timestamp = due_timestamp
+        self._date = None
+        self._due_date = None
+
+    def __repr__(self):
+        return (f'Alarm(id={self.id!r}, event={self.event!r},'
+            f' message={self.message!r}, date={self.date!r},'
+            f' due_date={self.due_date!r})')
+
+    def __eq__(self, other):
+        if not isinstance(other, Alarm):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def _key(self):
+        return (self.id, self.event, self.message, self.date_timestamp,
+            self.due_timestamp)
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = _from_utc_timestamp(self.date_timestamp)
+        return self._date
+
+    @property
+    def due_date(self):
+        if self._due_date is None:
+            self._due_date = _from_utc_timestamp(self.due_timestamp)
+        return self._due_date
+
+
+# Each entry upgrades the schema by one version, the current version is
+# stored in the user_version pragma of the database.
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS alarms (
+        id INTEGER PRIMARY KEY,
+        event TEXT NOT NULL,
+        date INTEGER NOT NULL,
+        due_date INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        vtodo INTEGER DEFAULT 0,
+        done INTEGER DEFAULT 0,
+        sequence INTEGER DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS occurences (
+        event TEXT PRIMARY KEY,
+        date INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS events (
+        event TEXT PRIMARY KEY,
+        sequence INTEGER,
+        path TEXT)
+    """,
+    """
+    CREATE INDEX alarms_date
+        ON alarms (vtodo, date, due_date, event, message);
+    CREATE INDEX alarms_todo_date
+        ON alarms (date, due_date) WHERE vtodo = 1 AND done = 0;
+    CREATE INDEX alarms_event ON alarms (event, sequence);
+    CREATE INDEX events_path ON events (path)
+    """,
+    """
+    DELETE FROM alarms WHERE id NOT IN (
+        SELECT MIN(id) FROM alarms
+        GROUP BY event, date, due_date, message);
+    DROP INDEX alarms_event;
+    CREATE UNIQUE INDEX alarms_unique
+        ON alarms (event, date, due_date, message)
+    """,
+    """
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL);
+    CREATE INDEX files_directory ON files (directory)
+    """,
+    # Pending todos are notified every day at the minute of their due date
+    # once their alarm date is reached, the minute of the day of the due date
+    # (UTC) is indexed to look them up
+    """
+    ALTER TABLE alarms ADD COLUMN due_minute INTEGER;
+    UPDATE alarms SET due_minute = ((due_date % 86400 + 86400) % 86400) / 60;
+    CREATE INDEX alarms_todo_minute
+        ON alarms (due_minute, date) WHERE vtodo = 1 AND done = 0
+    """,
+    """
+    ALTER TABLE events ADD COLUMN hash TEXT
+    """,
+    # Existing events are all renewed once to find the recurring ones
+    """
+    ALTER TABLE occurences ADD COLUMN renew INTEGER NOT NULL DEFAULT 0;
+    UPDATE occurences SET renew = 1
+    """,
+    ]
+
+
+class SQLiteDB:
+
+    def __init__(self, db_path=None, readonly=False):
+        self.db_path = ':memory:' if db_path is None else db_path
+        self.readonly = readonly
+        self._transaction_depth = 0
+        if self.db_path == ':memory:':
+            if readonly:
+                raise ValueError('An in-memory database cannot be read-only')
+            self._conn = sqlite3.connect(self.db_path)
+        elif readonly:
+            uri = pathlib.Path(self.db_path).absolute().as_uri()
+            self._conn = sqlite3.connect(f'{uri}?mode=ro', uri=True)
+            self._configure()
+        else:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._configure()
+
+        if readonly:
+            self._check_version()
+        else:
+            self._migrate()
+
+    def _configure(self):
+        for name, value in DB_PRAGMAS.items():
+            self._conn.execute(f'PRAGMA {name} = {value}')
+
+    def _check_version(self):
+        version, = self._conn.execute('PRAGMA user_version').fetchone()
+        if version != len(MIGRATIONS):
+            self._conn.close()
+            raise sqlite3.DatabaseError(
+                f'Database {self.db_path} is at version {version}, expected'
+                f' {len(MIGRATIONS)}')
+
+    def close(self):
+        self._conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._conn.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if not self._transaction_depth:
+            self._conn.commit()
+
+    def _migrate(self):
+        version, = self._conn.execute('PRAGMA user_version').fetchone()
+        for version, script in enumerate(MIGRATIONS[version:], version + 1):
+            logging.debug(
+                f'Migrating database {self.db_path} to version {version}')
+            self._conn.executescript(
+                f'BEGIN; {script}; PRAGMA user_version = {version}; COMMIT;')
+
+    @timed('db.remove_event')
+    def remove_event(self, uid):
+        self._conn.execute("DELETE FROM alarms WHERE event = ?", (uid,))
+        self._conn.execute("DELETE FROM occurences WHERE event = ?", (uid,))
+        self._conn.execute("DELETE FROM events WHERE event = ?", (uid,))
+        self._commit()
+
+    def add_alarm(self, event_uid, date, due_date, message, is_todo, sequence):
+        self.add_alarms([
+                (event_uid, date, due_date, message, is_todo, sequence)])
+
+    @timed('db.add_alarms')
+    def add_alarms(self, alarms):
+        def rows():
+            for event_uid, date, due_date, message, is_todo, sequence in (
+                    alarms):
+                due_timestamp = _to_utc_timestamp(due_date)
+                yield (event_uid, _to_utc_timestamp(date), due_timestamp,
+                    _minute_of_day(due_timestamp), message, int(is_todo),
+                    sequence)
+
+        self._conn.executemany("""
+            INSERT INTO alarms
+                (event, date, due_date, due_minute, message, vtodo, sequence)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (event, date, due_date, message) DO NOTHING
+            """, rows())
+        self._commit()
+
+    def get_alarms(self, start_date, end_date):
+        if start_date > end_date:
+            start_date, end_date = end_date, start_date
+        event_alarms = self.get_event_alarms(
+            _to_utc_timestamp(start_date), _to_utc_timestamp(end_date))
+        todo_alarms = self.get_due_todos(start_date, end_date)
+        logging.debug(
+            f'Found {len(event_alarms)} events and {len(todo_alarms)}'
+            ' todos to display')
+        return event_alarms + todo_alarms
+
+    @timed('db.get_event_alarms')
+    def get_event_alarms(self, start, end, event=None):
+        query = """
+            SELECT id, event, message, date, due_date
+            FROM alarms
+            WHERE (date >= ?) AND (date < ?) AND (vtodo = 0)
+            """
+        params = (start, end)
+        if event is not None:
+            query += " AND (event = ?)"
+            params += (event,)
+        cursor = self._conn.cursor()
+        cursor.execute(query, params)
+        return [Alarm(*r) for r in cursor.fetchall()]
+
+    def get_due_todos(self, start, end):
+        return self.get_todo_alarms(
+            _to_utc_timestamp(start), _to_utc_timestamp(end))
+
+    @timed('db.get_todo_alarms')
+    def get_todo_alarms(self, start, end, event=None):
+        # The todos reached before the end of the period whose due minute
+        # falls within it are notified
+        start -= start % 60
+        end += -end % 60
+        start_minute, end_minute = _minute_of_day(start), _minute_of_day(end)
+        # The window of minutes may wrap around midnight
+        if start >= end:
+            windows = []
+        elif end - start >= 86400:
+            windows = [(0, MINUTES_PER_DAY)]
+        elif start_minute < end_minute:
+            windows = [(start_minute, end_minute)]
+        else:
+            windows = [(start_minute, MINUTES_PER_DAY), (0, end_minute)]
+
+        query = """
+            SELECT id, event, message, date, due_date
+            FROM alarms INDEXED BY alarms_todo_minute
+            WHERE (due_minute >= ?) AND (due_minute < ?)
+                AND (date < ?) AND (vtodo = 1) AND (done = 0)
+            """
+        if event is not None:
+            query += " AND (event = ?)"
+        cursor = self._conn.cursor()
+        alarms = []
+        for window_start, window_end in windows:
+            params = (window_start, window_end, end)
+            if event is not None:
+                params += (event,)
+            cursor.execute(query, params)
+            alarms.extend(Alarm(*r) for r in cursor.fetchall())
+        return alarms
+
+    @timed('db.get_next_alarm_date')
+    def get_next_alarm_date(self, after):
+        after = _to_utc_timestamp(after)
+        cursor = self._conn.cursor()
+        cursor.execute("""
+            SELECT MIN(date) FROM alarms WHERE (vtodo = 0) AND (date >= ?)
+            """, (after,))
+        next_event, = cursor.fetchone()
+        dates = [d for d in (next_event, self._next_todo_date(after))
+            if d is not None]
+        if not dates:
+            return None
+        return _from_utc_timestamp(min(dates))
+
+    def _next_todo_date(self, after):
+        # The next todo already reached is the one with the first due minute
+        # following after, wrapping around midnight
+        cursor = self._conn.cursor()
+        after_minute = -(-(after % 86400) // 60)
+        dates = []
+        for window_start, window_end, offset in [
+                (after_minute, MINUTES_PER_DAY, 0),
+                (0, after_minute, 86400)]:
+            cursor.execute("""
+                SELECT due_minute FROM alarms INDEXED BY alarms_todo_minute
+                WHERE (due_minute >= ?) AND (due_minute < ?) AND (date <= ?)
+                    AND (vtodo = 1) AND (done = 0)
+                ORDER BY due_minute LIMIT 1
+                """, (window_start, window_end, after))
+            row = cursor.fetchone()
+            if row is not None:
+                dates.append(after - after % 86400 + row[0] * 60 + offset)
+                break
+
+        # Todos reached later on are notified at the latest a day after the
+        # first of them, only those reached before its notification matter
+        cursor.execute("""
+            SELECT date, due_minute FROM alarms
+            WHERE (date > ?) AND (vtodo = 1) AND (done = 0)
+            ORDER BY date LIMIT 1
+            """, (after,))
+        row = cursor.fetchone()
+        if row is not None:
+            date, due_minute = row
+            start = max(after, date - date % 60)
+            first = start + (due_minute * 60 - start) % 86400
+            cursor.execute("""
+                SELECT MIN(start + ((due_minute * 60 - start) % 86400 + 86400)
+                    % 86400)
+                FROM (
+                    SELECT MAX(?, date - date % 60) AS start, due_minute
+                    FROM alarms
+                    WHERE (date > ?) AND (date < ?) AND (vtodo = 1)
+                        AND (done = 0))
+                """, (after, after, first + 60))
+            dates.append(cursor.fetchone()[0])
+        return min(dates) if dates else None
+
+    @timed('db.set_done')
+    def set_done(self, event_id, status, sequence):
+        cursor = self._conn.cursor()
+        if status.upper() in {'COMPLETED', 'CANCELLED'}:
+            cursor.execute(
+                "UPDATE alarms SET done=1 WHERE event=?",
+                (event_id,))
+        else:
+            cursor.execute(
+                "UPDATE alarms SET done=1 WHERE event=? AND sequence<?",
+                (event_id, sequence))
+        self._commit()
+
+    @timed('db.add_last_occurence')
+    def add_last_occurence(self, event_uid, date, renew=False):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO occurences(event, date, renew)
+            VALUES (?, ?, ?)
+            """, (event_uid, _to_utc_timestamp(date), int(renew)))
+        self._commit()
+
+    @timed('db.get_last_occurences')
+    def get_last_occurences(self):
+        cursor = self._conn.cursor()
+        cursor.execute(
+            "SELECT event, MAX(date) FROM occurences GROUP BY event")
+        return {e: _from_utc_timestamp(d) for e, d in cursor.fetchall()}
+
+    @timed('db.get_stale_events')
+    def get_stale_events(self, before):
+        # Events with further occurences to materialize whose last
+        # materialized occurence is before the given date
+        cursor = self._conn.cursor()
+        cursor.execute("""
+            SELECT event, date FROM occurences
+            WHERE (renew = 1) AND (date < ?)
+            """, (_to_utc_timestamp(before),))
+        return {e: _from_utc_timestamp(d) for e, d in cursor.fetchall()}
+
+    @timed('db.get_ics_files')
+    def get_ics_files(self, events):
+        cursor = self._conn.cursor()
+        cursor.execute(
+            "SELECT event, path FROM events WHERE event in (%s)"
+            % ','.join('?' * len(events)),
+            list(events))
+        return dict(cursor.fetchall())
+
+    @timed('db.get_uids')
+    def get_uids(self, path):
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT event FROM events WHERE path=?", (str(path),))
+        return {r[0] for r in cursor}
+
+    @timed('db.get_events_sequence')
+    def get_events_sequence(self):
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT event, sequence FROM events")
+        return dict(cursor.fetchall())
+
+    @timed('db.get_fingerprints')
+    def get_fingerprints(self, directory, recursive=False):
+        cursor = self._conn.cursor()
+        if recursive:
+            # All the paths starting with the directory, using the primary key
+            prefix = os.path.join(str(directory), '')
+            cursor.execute(
+                "SELECT path, mtime_ns, size FROM files"
+                " WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        else:
+            cursor.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE directory=?",
+                (str(directory),))
+        return {p: (m, s) for p, m, s in cursor}
+
+    @timed('db.get_files')
+    def get_files(self):
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT path FROM files")
+        return {p for p, in cursor}
+
+    @timed('db.get_fingerprint')
+    def get_fingerprint(self, path):
+        cursor = self._conn.cursor()
+        cursor.execute(
+            "SELECT mtime_ns, size FROM files WHERE path=?", (str(path),))
+        return cursor.fetchone()
+
+    @timed('db.set_fingerprint')
+    def set_fingerprint(self, path, mtime_ns, size):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO files (path, directory, mtime_ns, size)
+            VALUES (?, ?, ?, ?)""",
+            (str(path), str(path.parent), mtime_ns, size))
+        self._commit()
+
+    @timed('db.remove_fingerprint')
+    def remove_fingerprint(self, path):
+        self._conn.execute("DELETE FROM files WHERE path=?", (str(path),))
+        self._commit()
+
+    @timed('db.get_event_hashes')
+    def get_event_hashes(self, path):
+        cursor = self._conn.cursor()
+        cursor.execute(
+            "SELECT event, hash FROM events WHERE path=?", (str(path),))
+        return dict(cursor.fetchall())
+
+    @timed('db.set_event_hash')
+    def set_event_hash(self, uid, content_hash):
+        self._conn.execute(
+            "UPDATE events SET hash=? WHERE event=?", (content_hash, uid))
+        self._commit()
+
+    @timed('db.add_event')
+    def add_event(self, uid, sequence, path):
+        # The content hash is kept when an event is renewed
+        self._conn.execute("""
+            INSERT INTO events (event, sequence, path) VALUES (?, ?, ?)
+            ON CONFLICT (event) DO UPDATE
+                SET sequence = excluded.sequence, path = excluded.path""",
+            (uid, int(sequence), str(path)))
+        self._commit()
+
+
+# Alarms firing in a sliding window sorted by notification date, the window
+# is filled from the database when a date outside of it is requested and then
+# kept up to date event by event.
+class AlarmTimeline:
+
+    def __init__(self, db, window=TIMELINE_WINDOW):
+        self.db = db
+        self.window = int(window.total_seconds())
+        self.start = self.end = None
+        self._entries = []
+
+    def _todo_firings(self, alarm):
+        # Every day of the window at the due minute, from the alarm date on
+        date = alarm.date_timestamp
+        due_time = alarm.due_timestamp - alarm.due_timestamp % 60
+        firing = max(self.start, date - date % 60)
+        firing += (due_time - firing) % 86400
+        while firing < self.end:
+            yield firing
+            firing += 86400
+
+    def _load(self, event=None):
+        for alarm in self.db.get_event_alarms(self.start, self.end, event):
+            yield (alarm.date_timestamp, alarm.id, alarm)
+        for alarm in self.db.get_todo_alarms(self.start, self.end, event):
+            for firing in self._todo_firings(alarm):
+                yield (firing, alarm.id, alarm)
+
+    def clear(self):
+        self.start = self.end = None
+        self._entries = []
+
+    def refill(self, start):
+        logging.debug(f'Refilling alarm timeline from {start}')
+        self.start, self.end = start, start + self.window
+        self._entries = sorted(self._load())
+
+    def reload(self, event):
+        if self.start is None:
+            return
+        self._entries = [e for e in self._entries if e[2].event != event]
+        for entry in self._load(event):
+            bisect.insort(self._entries, entry)
+
+    def _bounds(self, start, end):
+        if self.start is None or not (self.start <= start <= end <= self.end):
+            self.refill(start)
+        lo = bisect.bisect_left(self._entries, (start,))
+        return lo, bisect.bisect_left(self._entries, (end,), lo)
+
+    def firings(self, start, end):
+        # Unlike get, the alarms are kept in the timeline
+        start, end = _to_utc_timestamp(start), _to_utc_timestamp(end)
+        lo, hi = self._bounds(start, end)
+        return [(_from_utc_timestamp(e[0]), e[2])
+            for e in self._entries[lo:hi]]
+
+    def get(self, start, end):
+        start, end = _to_utc_timestamp(start), _to_utc_timestamp(end)
+        lo, hi = self._bounds(start, end)
+        alarms = [e[2] for e in self._entries[lo:hi]]
+        del self._entries[:lo]
+        self.start = start
+        return alarms
+
+    def next_date(self, after):
+        after = _to_utc_timestamp(after)
+        if self.start is not None and self.start <= after < self.end:
+            idx = bisect.bisect_left(self._entries, (after,))
+            if idx < len(self._entries):
+                return _from_utc_timestamp(self._entries[idx][0])
+            after = self.end
+        return self.db.get_next_alarm_date(_from_utc_timestamp(after))
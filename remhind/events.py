@@ -1,24 +1,38 @@
 import asyncio
-import calendar
+import collections
+import concurrent.futures
 import datetime as dt
+import functools
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import os
 import pathlib
-import sqlite3
-from dataclasses import dataclass, InitVar
-from typing import Optional
+import re
 
-import gi
 import icalendar
 import pytz
 from dateutil.rrule import rruleset, rrulestr
-from tzlocal import get_localzone
 
-gi.require_version('Notify', '0.7')
-from gi.repository import Notify  # noqa
+from .db import LOCAL_TZ, AlarmTimeline, SQLiteDB
+from .stats import STATS, timed, timer
 
-LOCAL_TZ = get_localzone()
 MIN_SEQ = -999
 MIN_DT = dt.datetime(1900, 1, 1, tzinfo=LOCAL_TZ)
+MAX_SLEEP = 300
+MAX_CATCH_UP = dt.timedelta(hours=1)
+COMPONENT_CACHE_SIZE = 64
+LARGE_CALENDAR_SIZE = 1024 * 1024
+INDEX_BATCH_SIZE = 256
+RULE_CACHE_SIZE = 1024
+HORIZON = dt.timedelta(days=7)
+MIN_OCCURENCES = 1
+MAX_OCCURENCES = 1000
+TZ_RE = re.compile(r'^TZID:(.*?)\r?$', re.MULTILINE | re.IGNORECASE)
+TZID_RE = re.compile(r';TZID="?([^;:"]+)"?[;:]', re.IGNORECASE)
+UID_RE = re.compile(r'^UID:(.*?)\r?$', re.MULTILINE | re.IGNORECASE)
+UNFOLD_RE = re.compile(r'\r?\n[ \t]')
 
 
 def _date2datetime(date):
@@ -32,17 +46,101 @@ def _date2datetime(date):
     return date
 
 
-def _to_utc_timestamp(dt):
-    if dt.tzinfo is not None:
-        dt = dt.astimezone(pytz.UTC)
-    return calendar.timegm(dt.timetuple())
+def _fingerprint(path):
+    stat = path.stat()
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _iter_blocks(lines):
+    depth, block = 0, None
+    for line in lines:
+        name = line.rstrip('\r\n').upper()
+        if name.startswith('BEGIN:'):
+            depth += 1
+            if depth == 2:
+                block_name, block = name[6:], []
+        if block is not None:
+            block.append(line)
+        if name.startswith('END:'):
+            depth -= 1
+            if depth == 1 and block is not None:
+                yield block_name, ''.join(block)
+                block = None
+
+
+def _parse_block(block, timezones):
+    if timezones is not None:
+        block = ''.join(
+            ['BEGIN:VCALENDAR\r\n', *timezones, block, 'END:VCALENDAR\r\n'])
+    with timer('parse'):
+        cal = icalendar.Calendar.from_ical(block)
+    for component in cal.subcomponents:
+        if isinstance(component, (icalendar.Event, icalendar.Todo)):
+            yield component
+
+
+def iter_calendar_components(ics, uids=None):
+    if uids is None and ics.stat().st_size <= LARGE_CALENDAR_SIZE:
+        yield from _parse_block(ics.read_text(), None)
+        return
+
+    # Read the calendar one component at a time, parsing each of them with the
+    # VTIMEZONE it refers to, so that huge calendars are never fully loaded
+    timezones, deferred = {}, []
+    with ics.open() as fd:
+        for name, block in _iter_blocks(fd):
+            if name == 'VTIMEZONE':
+                match = TZ_RE.search(_unfold(block))
+                if match:
+                    timezones[match.group(1).strip()] = block
+                continue
+            elif name not in {'VEVENT', 'VTODO'}:
+                continue
+            unfolded = _unfold(block)
+            if uids is not None:
+                match = UID_RE.search(unfolded)
+                if not match or match.group(1).strip() not in uids:
+                    continue
+            tzids = {t.strip() for t in TZID_RE.findall(unfolded)}
+            # Unknown time zones may be defined further in the file
+            if any(t not in timezones and t not in pytz.all_timezones_set
+                    for t in tzids):
+                deferred.append((block, tzids))
+                continue
+            yield from _parse_block(
+                block, [timezones[t] for t in tzids if t in timezones])
+    for block, tzids in deferred:
+        yield from _parse_block(
+            block, [timezones[t] for t in tzids if t in timezones])
+
+
+def _unfold(block):
+    return UNFOLD_RE.sub('', block)
+
 
+def _parse_calendar_file(ics):
+    # Runs in the worker processes of CalendarStore, the fingerprint is
+    # taken before reading so that a concurrent write is detected later on
+    fingerprint = _fingerprint(ics)
+    return fingerprint, list(iter_calendar_components(ics))
 
-def _from_utc_timestamp(timestamp, tz=None):
-    if tz is None:
-        tz = LOCAL_TZ
-    return dt.datetime.fromtimestamp(
-        timestamp, tz=pytz.UTC).astimezone(tz)
+
+def _parse_pooled_calendar_file(ics):
+    # The files which could not be parsed by the workers are parsed again by
+    # CalendarStore, which reports the error
+    try:
+        return _parse_calendar_file(ics)
+    except Exception:
+        return None
+
+
+def _component_digest(component):
+    return hashlib.sha1(component.to_ical()).digest()
+
+
+def _content_hash(digests):
+    # Independent of the order of the components sharing an UID
+    return hashlib.sha1(b''.join(sorted(digests))).hexdigest()
 
 
 def parse_rule(component):
@@ -86,6 +184,17 @@ def parse_rule(component):
     return rule_set
 
 
+def _rule_key(component):
+    values = []
+    for name in ['dtstart', 'due', 'rrule', 'rdate', 'exrule', 'exdate']:
+        properties = component.get(name, [])
+        if not isinstance(properties, list):
+            properties = [properties]
+        for prop in properties:
+            values.append((name, prop.to_ical(), prop.params.to_ical()))
+    return (int(component.get('sequence', 0)), hash(tuple(values)))
+
+
 def get_component_from_ics(uid, ics):
     cal = icalendar.Calendar.from_ical(ics)
     for component in cal.walk():
@@ -94,181 +203,106 @@ def get_component_from_ics(uid, ics):
     return None
 
 
-@dataclass
-class Alarm:
-    id: int
-    event: str
-    message: str
-    date_timestamp: InitVar
-    due_timestamp: InitVar
-    date: Optional[dt.datetime] = None
-    due_date: Optional[dt.datetime] = None
-
-    def __post_init__(self, date_timestamp, due_timestamp):
-        self.date = _from_utc_timestamp(date_timestamp)
-        self.due_date = _from_utc_timestamp(due_timestamp)
-
-
-class SQLiteDB:
-
-    def __init__(self, db_path=None):
-        self.db_path = ':memory:' if db_path is None else db_path
-        init_db = db_path is None or not self.db_path.exists()
-        self._conn = sqlite3.connect(self.db_path)
-        if init_db:
-            self._init_db()
-
-    def _init_db(self):
-        logging.debug(f'Initializing database {self.db_path}')
-        self._conn.execute("""
-            CREATE TABLE alarms (
-                id INTEGER PRIMARY KEY,
-                event TEXT NOT NULL,
-                date INTEGER NOT NULL,
-                due_date INTEGER NOT NULL,
-                message TEXT NOT NULL,
-                vtodo INTEGER DEFAULT 0,
-                done INTEGER DEFAULT 0,
-                sequence INTEGER DEFAULT 0)""")
-        self._conn.execute("""
-            CREATE TABLE occurences (
-                event TEXT PRIMARY KEY,
-                date INTEGER NOT NULL)""")
-        self._conn.execute("""
-            CREATE TABLE events (
-                event TEXT PRIMARY KEY,
-                sequence INTEGER,
-                path TEXT)""")
-        self._conn.commit()
-
-    def remove_event(self, uid):
-        self._conn.execute("DELETE FROM alarms WHERE event = ?", (uid,))
-        self._conn.execute("DELETE FROM occurences WHERE event = ?", (uid,))
-        self._conn.execute("DELETE FROM events WHERE event = ?", (uid,))
-        self._conn.commit()
-
-    def add_alarm(self, event_uid, date, due_date, message, is_todo, sequence):
-        date = _to_utc_timestamp(date)
-        due_date = _to_utc_timestamp(due_date)
-        cursor = self._conn.cursor()
-        cursor.execute(
-            "SELECT 1 FROM alarms"
-            " WHERE event=? AND date=?  AND due_date=? AND message=?",
-            (event_uid, date, due_date, message))
-        if not cursor.fetchone():
-            cursor.execute("""
-                INSERT INTO alarms
-                    (event, date, due_date, message, vtodo, sequence)
-                VALUES (?, ?, ?, ?, ?, ?)""",
-                (event_uid, date, due_date, message, int(is_todo), sequence))
-            self._conn.commit()
-
-    def get_alarms(self, start_date, end_date):
-        if start_date > end_date:
-            start_date, end_date = end_date, start_date
-        event_alarms = self.get_event_alarms(
-            _to_utc_timestamp(start_date), _to_utc_timestamp(end_date))
-        todo_alarms = self.get_due_todos(start_date, end_date)
-        logging.debug(
-            f'Found {len(event_alarms)} events and {len(todo_alarms)}'
-            ' todos to display')
-        return event_alarms + todo_alarms
-
-    def get_event_alarms(self, start, end):
-        cursor = self._conn.cursor()
-        cursor.execute("""
-            SELECT id, event, message, date, due_date
-            FROM alarms
-            WHERE (date >= ?) AND (date < ?) AND (vtodo = 0)
-            """, (start, end))
-        return [Alarm(*r) for r in cursor.fetchall()]
-
-    def get_due_todos(self, start, end):
-        start = start.astimezone(pytz.UTC)
-        end = end.astimezone(pytz.UTC)
-        start_time = (start.hour, start.minute)
-        end_time = (end.hour, end.minute)
-
-        def match_time(alarm):
-            date = alarm.due_date.astimezone(pytz.UTC)
-            if start_time < end_time:
-                return start_time <= (date.hour, date.minute) < end_time
-            elif start_time == end_time:
-                return start != end
-            else:
-                return (start_time <= (date.hour, date.minute)
-                    or (date.hour, date.minute) < end_time)
-
-        cursor = self._conn.cursor()
-        cursor.execute("""
-            SELECT id, event, message, date, due_date
-            FROM alarms
-            WHERE (date < ?) AND (vtodo = 1) AND (done = 0)
-            """, (_to_utc_timestamp(end),))
-        return list(filter(match_time, (Alarm(*r) for r in cursor.fetchall())))
-
-    def set_done(self, event_id, status, sequence):
-        cursor = self._conn.cursor()
-        if status.upper() in {'COMPLETED', 'CANCELLED'}:
-            cursor.execute(
-                "UPDATE alarms SET done=1 WHERE event=?",
-                (event_id,))
-        else:
-            cursor.execute(
-                "UPDATE alarms SET done=1 WHERE event=? AND sequence<?",
-                (event_id, sequence))
-        self._conn.commit()
-
-    def add_last_occurence(self, event_uid, date):
-        self._conn.execute("""
-            INSERT OR REPLACE INTO occurences(event, date)
-            VALUES (?, ?)
-            """, (event_uid, _to_utc_timestamp(date)))
-        self._conn.commit()
-
-    def get_last_occurences(self):
-        cursor = self._conn.cursor()
-        cursor.execute(
-            "SELECT event, MAX(date) FROM occurences GROUP BY event")
-        return {e: _from_utc_timestamp(d) for e, d in cursor.fetchall()}
-
-    def get_ics_files(self, events):
-        cursor = self._conn.cursor()
-        cursor.execute(
-            "SELECT event, path FROM events WHERE event in (%s)"
-            % ','.join('?' * len(events)),
-            list(events))
-        return dict(cursor.fetchall())
-
-    def get_uids(self, path):
-        cursor = self._conn.cursor()
-        cursor.execute("SELECT event FROM events WHERE path=?", (str(path),))
-        return {r[0] for r in cursor}
-
-    def get_events_sequence(self):
-        cursor = self._conn.cursor()
-        cursor.execute("SELECT event, sequence FROM events")
-        return dict(cursor.fetchall())
-
-    def add_event(self, uid, sequence, path):
-        self._conn.execute("""
-            INSERT OR REPLACE INTO events (event, sequence, path)
-            VALUES (?, ?, ?)""",
-            (uid, int(sequence), str(path)))
-        self._conn.commit()
+class ComponentCache:
+
+    def __init__(self, maxsize=COMPONENT_CACHE_SIZE,
+            max_file_size=LARGE_CALENDAR_SIZE):
+        self.maxsize = maxsize
+        self.max_file_size = max_file_size
+        self._cache = collections.OrderedDict()
+
+    def cacheable(self, fingerprint):
+        return fingerprint[1] <= self.max_file_size
+
+    def put(self, ics, fingerprint, components):
+        ics = pathlib.Path(ics)
+        uids = {}
+        for component in components:
+            uids.setdefault(str(component['uid']), component)
+        self._cache[ics] = (fingerprint, uids)
+        self._cache.move_to_end(ics)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return uids
+
+    def get_components(self, ics):
+        ics = pathlib.Path(ics)
+        fingerprint, uids = self._cache.get(ics, (None, None))
+        if fingerprint is not None and fingerprint == _fingerprint(ics):
+            self._cache.move_to_end(ics)
+            return uids
+        return self.put(ics, *_parse_calendar_file(ics))
+
+    def get_many(self, uids, ics):
+        # Large calendars are read once for all the requested events
+        ics = pathlib.Path(ics)
+        if self.cacheable(_fingerprint(ics)):
+            components = self.get_components(ics)
+            return {uid: components[uid] for uid in uids if uid in components}
+        found = {}
+        for component in iter_calendar_components(ics, set(uids)):
+            found.setdefault(str(component['uid']), component)
+        return found
+
+    def discard(self, ics):
+        self._cache.pop(pathlib.Path(ics), None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class RuleCache:
+
+    def __init__(self, maxsize=RULE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+
+    def get(self, component):
+        uid = str(component['uid'])
+        key = _rule_key(component)
+        cached_key, rule_set = self._cache.get(uid, (None, None))
+        if cached_key != key:
+            rule_set = parse_rule(component)
+            self._cache[uid] = (key, rule_set)
+        self._cache.move_to_end(uid)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return rule_set
+
+    def discard(self, uid):
+        self._cache.pop(uid, None)
+
+    def clear(self):
+        self._cache.clear()
 
 
 class EventCollection:
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, horizon=HORIZON,
+            min_occurences=MIN_OCCURENCES, max_occurences=MAX_OCCURENCES):
         self.db = SQLiteDB(db_path)
+        self.timeline = AlarmTimeline(self.db)
+        self.components = ComponentCache()
+        self.rules = RuleCache()
+        # Recurring events are materialized up to the horizon, renewals
+        # happen when their last materialized occurence is notified
+        self.horizon = horizon
+        self.min_occurences = min_occurences
+        self.max_occurences = max_occurences
         self._last_occurences = self.db.get_last_occurences()
 
+    @timed('events.add')
     def add(self, cal_obj, ics, occurence=None):
+        with self.db.transaction():
+            self._add(cal_obj, ics, occurence)
+        self.timeline.reload(cal_obj['uid'])
+
+    def _add(self, cal_obj, ics, occurence=None):
         logging.debug(f"Adding event '{cal_obj['uid']}'"
             f" from {ics} starting at {occurence}")
 
         obj_sequence = int(cal_obj.get('sequence', 0))
+        self.db.add_event(cal_obj['uid'], obj_sequence, ics)
         if isinstance(cal_obj, icalendar.Todo):
             if cal_obj.get('status', '').upper() in {'COMPLETED', 'CANCELLED'}:
                 self.db.set_done(
@@ -281,8 +315,6 @@ class EventCollection:
         if (occurence is not None
                 and occurence < self._last_occurences[cal_obj['uid']]):
             return
-        obj_sequence = int(cal_obj.get('sequence', 0))
-        self.db.add_event(cal_obj['uid'], obj_sequence, ics)
 
         summary = cal_obj.get('summary', '')
         if 'dtstart' in cal_obj:
@@ -302,6 +334,8 @@ class EventCollection:
         if occurence is None:
             occurence = latest_occurence
 
+        alarms = []
+
         def _add_occurence(dt, sequence):
             is_todo = isinstance(cal_obj, icalendar.Todo)
             for component in cal_obj.subcomponents:
@@ -320,13 +354,13 @@ class EventCollection:
 
                 message = component.get('description', summary)
                 if message:
-                    self.db.add_alarm(
-                        cal_obj['uid'], alarm_dt, dt, message, is_todo,
-                        sequence)
+                    alarms.append((
+                            cal_obj['uid'], alarm_dt, dt, message, is_todo,
+                            sequence))
 
             if summary:
-                self.db.add_alarm(
-                    cal_obj['uid'], dt, dt, summary, is_todo, sequence)
+                alarms.append((
+                        cal_obj['uid'], dt, dt, summary, is_todo, sequence))
 
         has_rules = ('rrule' in cal_obj or 'exrule' in cal_obj
             or 'rdate' in cal_obj or 'exdate' in cal_obj)
@@ -334,26 +368,50 @@ class EventCollection:
         if not has_rules:
             if start_dt:
                 _add_occurence(start_dt, sequence)
+                self.db.add_alarms(alarms)
                 self.db.add_last_occurence(cal_obj['uid'], start_dt)
         else:
             now = dt.datetime.now(tz=LOCAL_TZ).replace(second=0, microsecond=0)
             if latest_occurence:
                 now = max(now, latest_occurence)
-            rules = parse_rule(cal_obj)
-            for idx, occurence in enumerate(rules.xafter(now, 10, inc=True)):
+            horizon = now + self.horizon
+            rules = self.rules.get(cal_obj)
+            # Finite rules whose occurences were all materialized are never
+            # renewed again
+            renew = False
+            # The last materialized occurence is not counted again
+            inc = now != self._last_occurences.get(cal_obj['uid'])
+            for idx, rule_occurence in enumerate(rules.xafter(now, inc=inc)):
+                if idx >= self.max_occurences or (
+                        idx >= self.min_occurences
+                        and rule_occurence > horizon):
+                    renew = True
+                    break
+                occurence = rule_occurence
                 _add_occurence(occurence, sequence + idx)
-            self.db.add_last_occurence(cal_obj['uid'], occurence)
+            self.db.add_alarms(alarms)
+            self.db.add_last_occurence(cal_obj['uid'], occurence, renew)
             latest_occurence = occurence
         self._last_occurences[cal_obj['uid']] = latest_occurence
 
     def remove(self, path):
-        for uid in self.db.get_uids(path):
-            self.db.remove_event(uid)
+        with self.db.transaction():
+            for uid in self.db.get_uids(path):
+                self.remove_event(uid)
+
+    def remove_event(self, uid):
+        logging.debug(f"Removing event '{uid}'")
+        self.db.remove_event(uid)
+        self._last_occurences.pop(uid, None)
+        self.rules.discard(uid)
+        self.timeline.reload(uid)
+
+    def get_next_alarm_date(self, after):
+        return self.timeline.next_date(after)
 
     def get_due_alarms(self, date):
         end_date = date + dt.timedelta(minutes=1)
-        db_alarms = self.db.get_alarms(date, end_date)
-        alarms2ics = self.db.get_ics_files({a.event for a in db_alarms})
+        db_alarms = self.timeline.get(date, end_date)
 
         max_alarms = {}
         for alarm in db_alarms:
@@ -362,68 +420,463 @@ class EventCollection:
                     max_alarms[alarm.event], alarm.due_date)
             else:
                 max_alarms[alarm.event] = alarm.due_date
-        to_renew = {event for event, date in max_alarms.items()
-            if date >= self._last_occurences.get(event, MIN_DT)}
-        for event_uid, ics in alarms2ics.items():
-            if event_uid not in to_renew:
-                continue
-            event = get_component_from_ics(
-                event_uid, pathlib.Path(ics).read_text())
-            self.add(event, ics, max_alarms[event_uid])
+        self._renew({event: date for event, date in max_alarms.items()
+                if date >= self._last_occurences.get(event, MIN_DT)})
 
         return db_alarms
 
+    def get_due_alarms_by_minute(self, start, end):
+        # The alarms of each minute are notified apart, as if every minute
+        # had been checked on time
+        minutes = []
+        while start < end:
+            minutes.append(self.get_due_alarms(start))
+            start += dt.timedelta(minutes=1)
+        return minutes
+
+    def renew_stale_events(self, now):
+        # Recurring events whose last materialized occurence passed while
+        # the daemon was not running would otherwise never be notified again
+        stale = self.db.get_stale_events(now)
+        if stale:
+            logging.info(f'Renewing {len(stale)} recurring events')
+        with self.db.transaction():
+            self._renew(stale)
+
+    def _renew(self, occurences):
+        alarms2ics = self.db.get_ics_files(occurences) if occurences else {}
+        ics2uids = collections.defaultdict(list)
+        for event_uid, ics in alarms2ics.items():
+            ics2uids[ics].append(event_uid)
+        for ics, uids in ics2uids.items():
+            try:
+                with timer('renew.read'):
+                    components = self.components.get_many(uids, ics)
+            except OSError:
+                logging.exception(f'Could not renew events from {ics}')
+                continue
+            for event_uid in uids:
+                event = components.get(event_uid)
+                if event is None:
+                    logging.warning(f"Event '{event_uid}' not found in {ics}")
+                    continue
+                with timer('renew'):
+                    self.add(event, ics, occurences[event_uid])
+                STATS.increment('renewals')
+
 
 class CalendarStore:
 
-    def __init__(self, sources, db_path):
+    def __init__(self, sources, db_path, workers=None, horizon=HORIZON):
         self.sources = sources
-        self.events = EventCollection(db_path)
+        self.workers = os.cpu_count() if workers is None else workers
+        self.events = EventCollection(db_path, horizon=horizon)
+        self.listeners = []
+        # Calendars may have been removed from the configuration while the
+        # daemon was not running
+        self._remove_uncovered(self.events.db.get_files())
+        self._index_sources(sources)
+        self.events.renew_stale_events(dt.datetime.now(LOCAL_TZ))
+
+    def _notify_listeners(self):
+        for listener in self.listeners:
+            listener()
+
+    def set_sources(self, sources):
+        self.index(*self.replace_sources(sources))
+
+    def replace_sources(self, sources):
+        def source_key(source):
+            return (pathlib.Path(source['path']).expanduser(),
+                bool(source.get('recursive', False)))
+
+        old_keys = {source_key(s) for s in self.sources}
+        new_keys = {source_key(s) for s in sources}
+        self.sources = list(sources)
+        with self.events.db.transaction():
+            for cal_path, recursive in old_keys - new_keys:
+                logging.info(f'Removing calendar {cal_path}')
+                self._remove_uncovered(self.events.db.get_fingerprints(
+                        cal_path, recursive))
+        return self.scan_sources(
+            [s for s in sources if source_key(s) not in old_keys])
+
+    def _remove_uncovered(self, paths):
+        # Files also covered by a remaining calendar are kept
+        with self.events.db.transaction():
+            for ics in paths:
+                if not self._is_covered(ics):
+                    self.remove_file(pathlib.Path(ics))
+
+    def _index_sources(self, sources):
+        self.index(*self.scan_sources(sources))
+
+    # Indexing is split in three steps so that AsyncCalendarStore only runs
+    # the database accesses in the store thread: the scan returns the files
+    # to parse along with the hashes of their indexed events and the files
+    # to remove, the parsing does not touch the database and index_file
+    # writes the result of the parsing one batch of components at a time.
+    def scan_sources(self, sources):
+        changed, removed = [], []
         for source in sources:
-            self.add_source_events(source)
-
-    def add_source_events(self, source):
-        for cal_file, component in self.get_interesting_components(source):
-            self.events.add(component, cal_file)
-
-    def get_interesting_components(self, source):
-        cal_path = pathlib.Path(source['path'])
-        for ics in cal_path.expanduser().glob('*.ics'):
-            yield from self._get_components_from_ics(ics)
-
-    def _get_components_from_ics(self, ics):
-        cal = icalendar.Calendar.from_ical(ics.read_text())
-        for component in cal.subcomponents:
-            if isinstance(component, (icalendar.Event, icalendar.Todo)):
-                yield (ics, component)
+            cal_path = pathlib.Path(source['path']).expanduser()
+            fingerprints = self.events.db.get_fingerprints(
+                cal_path, source.get('recursive', False))
+            for ics in self.get_calendar_files(source):
+                fingerprint = fingerprints.pop(str(ics), None)
+                if fingerprint != _fingerprint(ics):
+                    logging.info(f'Indexing events from {ics}')
+                    changed.append(
+                        (ics, self.events.db.get_event_hashes(ics)))
+            removed.extend(pathlib.Path(p) for p in fingerprints)
+        return changed, removed
+
+    def scan_file(self, ics):
+        fingerprint = self.events.db.get_fingerprint(ics)
+        if not ics.exists():
+            return [], [ics] if fingerprint is not None else []
+        elif fingerprint is None:
+            logging.info(f'Adding events from {ics}')
+        elif fingerprint != _fingerprint(ics):
+            logging.info(f'Updating events from {ics}')
+        else:
+            return [], []
+        return self._changed_file(ics)
+
+    def scan(self, path=None):
+        if path is None:
+            return self.scan_sources(self.sources)
+        recursive, path = self._resolve(path)
+        # A directory which was removed has its files removed as well
+        if path.suffix != '.ics' or path.is_dir():
+            return self.scan_sources(
+                [{'path': str(path), 'recursive': recursive}])
+        return self.scan_file(path)
+
+    def index(self, changed, removed):
+        with self.events.db.transaction():
+            for ics in removed:
+                self.remove_file(ics)
+            failed = None
+            for parsed in self.parse_files(changed):
+                # The remaining batches of a file which failed are skipped,
+                # it is indexed again by the next scan
+                if parsed[0] == failed:
+                    continue
+                try:
+                    self.index_file(parsed)
+                except Exception:
+                    logging.exception(
+                        f'Could not index events from {parsed[0]}')
+                    failed = parsed[0]
+
+    def parse_files(self, changed):
+        hashes = dict(changed)
+        # Large calendars are streamed in this process, the workers would
+        # send back all their components at once
+        pooled = []
+        for ics in hashes:
+            try:
+                if ics.stat().st_size <= LARGE_CALENDAR_SIZE:
+                    pooled.append(ics)
+            except OSError:
+                # Reported when the file is parsed
+                continue
+        if self.workers > 1 and len(pooled) > self.workers:
+            for ics, parsed in self._parse_pooled(pooled):
+                if parsed is not None:
+                    yield from self._parse_file(ics, hashes.pop(ics), *parsed)
+        for ics, ics_hashes in hashes.items():
+            yield from self._parse_file(ics, ics_hashes)
+
+    def _parse_file(self, ics, hashes, *parsed):
+        # A file which cannot be parsed, or which was removed since the scan,
+        # does not prevent the other ones from being indexed
+        try:
+            yield from self.parse_file(ics, hashes, *parsed)
+        except Exception:
+            logging.exception(f'Could not parse events from {ics}')
+
+    def _parse_pooled(self, files):
+        chunksize = max(1, len(files) // (self.workers * 4))
+        # The store runs in a thread of the daemon, forking it could leave a
+        # lock held by another thread (notifier, statistics) in the workers
+        context = multiprocessing.get_context('forkserver')
+        with concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context) as pool:
+            yield from zip(files, pool.map(
+                    _parse_pooled_calendar_file, files, chunksize=chunksize))
+
+    def get_calendar_files(self, source):
+        cal_path = pathlib.Path(source['path']).expanduser()
+        if not source.get('recursive', False):
+            yield from cal_path.glob('*.ics')
+            return
+        # Collections are discovered at any depth, hidden directories
+        # (version control, synchronization metadata) are skipped
+        for dirpath, dirnames, filenames in os.walk(cal_path):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.endswith('.ics'):
+                    yield pathlib.Path(dirpath) / filename
+
+    def parse_file(self, ics, hashes, fingerprint=None, components=None):
+        if fingerprint is None:
+            fingerprint = _fingerprint(ics)
+            components = iter_calendar_components(ics)
+        cacheable = self.events.components.cacheable(fingerprint)
+        with timer('store.parse_file'):
+            if cacheable:
+                components = list(components)
+            # Only the events whose content changed since the file was last
+            # indexed are replaced, the others keep their alarms
+            digests = collections.defaultdict(list)
+            for component in components:
+                digests[str(component['uid'])].append(
+                    _component_digest(component))
+        content_hashes = {
+            uid: _content_hash(uid_digests)
+            for uid, uid_digests in digests.items()}
+        changed = {uid for uid, content_hash in content_hashes.items()
+            if hashes.get(uid) != content_hash}
+        # Large calendars are read a second time rather than kept in memory,
+        # only the components which changed are parsed again
+        if cacheable:
+            added = iter([c for c in components if str(c['uid']) in changed])
+        elif changed:
+            added = iter_calendar_components(ics, changed)
+        else:
+            added = iter([])
+        # The changed components are indexed in batches so that a first index
+        # never holds a whole large calendar. The first batch removes the
+        # outdated events and the last one records the hashes and the
+        # fingerprint, a file whose indexing was interrupted is thus indexed
+        # again.
+        first, batch = True, list(itertools.islice(added, INDEX_BATCH_SIZE))
+        while True:
+            following = next(added, None)
+            last = following is None
+            yield (ics, first, fingerprint if last else None, content_hashes,
+                changed, batch, components if cacheable and last else None)
+            if last:
+                break
+            first, batch = False, [
+                following, *itertools.islice(added, INDEX_BATCH_SIZE - 1)]
+
+    @timed('store.index_file')
+    def index_file(self, parsed):
+        (ics, first, fingerprint, content_hashes, changed, added,
+            components) = parsed
+        with self.events.db.transaction():
+            if first:
+                hashes = self.events.db.get_event_hashes(ics)
+                for uid in (hashes.keys() - content_hashes.keys()) | (
+                        hashes.keys() & changed):
+                    self.events.remove_event(uid)
+            for component in added:
+                self.events.add(component, ics)
+            if fingerprint is not None:
+                for uid in changed:
+                    self.events.db.set_event_hash(uid, content_hashes[uid])
+                self.events.db.set_fingerprint(ics, *fingerprint)
+        if components is not None:
+            self.events.components.put(ics, fingerprint, components)
+        self._notify_listeners()
 
     def add_file(self, ics):
         logging.info(f'Adding events from {ics}')
-        for cal_file, component in self._get_components_from_ics(ics):
-            self.events.add(component, cal_file)
+        self.index(*self._changed_file(ics))
 
     def remove_file(self, ics):
         logging.info(f'Removing events from {ics}')
-        self.events.remove(ics)
+        self.events.components.discard(ics)
+        with self.events.db.transaction():
+            self.events.remove(ics)
+            self.events.db.remove_fingerprint(ics)
+        self._notify_listeners()
 
     def modify_file(self, ics):
         logging.info(f'Updating events from {ics}')
-        for cal_file, component in self._get_components_from_ics(ics):
-            self.events.add(component, cal_file)
+        self.index(*self._changed_file(ics))
+
+    def _changed_file(self, ics):
+        return [(ics, self.events.db.get_event_hashes(ics))], []
+
+    def _resolve(self, path):
+        # Only the files of the calendars are indexed, a recursive calendar
+        # covers all its subdirectories but the hidden ones. The path is
+        # returned relative to the matching calendar as its files are stored
+        # in the database.
+        path = pathlib.Path(path).expanduser().absolute()
+        is_file = path.suffix == '.ics' and not path.is_dir()
+        matches = []
+        for source in self.sources:
+            cal_path = pathlib.Path(source['path']).expanduser()
+            recursive = bool(source.get('recursive', False))
+            try:
+                relative = path.relative_to(cal_path.absolute())
+            except ValueError:
+                continue
+            directories = relative.parts[:len(relative.parts) - is_file]
+            if recursive and any(d.startswith('.') for d in directories):
+                continue
+            if recursive or not directories:
+                matches.append((recursive, cal_path / relative))
+        if not matches:
+            raise ValueError(f'{path} is not part of a calendar')
+        return max(matches, key=lambda m: m[0])
+
+    def _is_covered(self, path):
+        try:
+            self._resolve(path)
+        except ValueError:
+            return False
+        return True
+
+    def rescan(self, path=None):
+        self.index(*self.scan(path))
+
+    def flush_caches(self):
+        logging.info('Flushing caches')
+        self.events.components.clear()
+        self.events.rules.clear()
+        self.events.timeline.clear()
+
+    def sync_file(self, ics):
+        self.index(*self.scan_file(ics))
+
+
+# Runs a CalendarStore in a dedicated thread, storage operations are executed
+# one at a time in the order they were submitted and awaited from the event
+# loop so that a long indexing never delays the alarms or inotify events.
+# Calendar files are parsed in another thread, only their database updates
+# are queued with the alarm queries.
+class AsyncCalendarStore:
+
+    def __init__(self, store, executor, parse_executor):
+        self.store = store
+        self._executor = executor
+        self._parse_executor = parse_executor
+        # The hashes returned by a scan must not change before the parsed
+        # files are indexed
+        self._index_lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        # SQLite connections can only be used by the thread which opened them
+        executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='remhind-db')
+        store = await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(CalendarStore, *args, **kwargs))
+        parse_executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='remhind-parse')
+        return cls(store, executor, parse_executor)
+
+    @property
+    def listeners(self):
+        return self.store.listeners
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args))
+
+    def _parse(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self._parse_executor, functools.partial(func, *args))
+
+    async def _index(self, scan, *args):
+        async with self._index_lock:
+            changed, removed = await self.run(scan, *args)
+            for ics in removed:
+                await self.run(self.store.remove_file, ics)
+            parsed_files = self.store.parse_files(changed)
+            failed = None
+            try:
+                while True:
+                    parsed = await self._parse(next, parsed_files, None)
+                    if parsed is None:
+                        break
+                    elif parsed[0] == failed:
+                        continue
+                    try:
+                        await self.run(self.store.index_file, parsed)
+                    except Exception:
+                        logging.exception(
+                            f'Could not index events from {parsed[0]}')
+                        failed = parsed[0]
+            finally:
+                await self._parse(parsed_files.close)
+
+    def sync_file(self, ics):
+        return self._index(self.store.scan_file, ics)
+
+    def rescan(self, path=None):
+        return self._index(self.store.scan, path)
+
+    def set_sources(self, sources):
+        return self._index(self.store.replace_sources, sources)
+
+    def flush_caches(self):
+        return self.run(self.store.flush_caches)
+
+    def get_due_alarms(self, date):
+        return self.run(self.store.events.get_due_alarms, date)
 
+    def get_due_alarms_by_minute(self, start, end):
+        return self.run(
+            self.store.events.get_due_alarms_by_minute, start, end)
+
+    def renew_stale_events(self, now):
+        return self.run(self.store.events.renew_stale_events, now)
+
+    def get_next_alarm_date(self, after):
+        return self.run(self.store.events.get_next_alarm_date, after)
+
+    async def close(self):
+        await self.run(self.store.events.db.close)
+        self._executor.shutdown()
+        self._parse_executor.shutdown()
+
+
+async def check_events(calendar_store, notifier):
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    calendar_store.listeners.append(
+        lambda: loop.call_soon_threadsafe(wakeup.set))
 
-async def check_events(calendar_store):
     last_check = None
     while True:
         now = dt.datetime.now(LOCAL_TZ).replace(second=0, microsecond=0)
         if last_check is None or (last_check != now):
+            # The minutes skipped while the store was busy are checked as
+            # well, unless the clock jumped (suspend, time change) in which
+            # case only the recurring events missing a renewal are caught up
+            start = now
+            if last_check is not None:
+                if now - MAX_CATCH_UP <= last_check < now:
+                    start = last_check + dt.timedelta(minutes=1)
+                else:
+                    await calendar_store.renew_stale_events(now)
             last_check = now
-            due_alarms = calendar_store.events.get_due_alarms(now)
-            for alarm in due_alarms:
-                logging.debug(
-                    f'Notifying of alarm {alarm.id} "{alarm.message}"')
-                n = Notify.Notification.new(
-                    "{a.due_date:%H:%M} {a.message}".format(a=alarm), "Alarm")
-                n.show()
-        # Take some security to ensure we don't miss any minute
-        await asyncio.sleep(45)
+            for due_alarms in await calendar_store.get_due_alarms_by_minute(
+                    start, now + dt.timedelta(minutes=1)):
+                for alarm in due_alarms:
+                    logging.debug(
+                        f'Notifying of alarm {alarm.id} "{alarm.message}"')
+                notifier.notify(due_alarms)
+
+        next_alarm = await calendar_store.get_next_alarm_date(
+            now + dt.timedelta(minutes=1))
+        # The monotonic clock used by asyncio stops during suspend, never
+        # sleep long enough to miss alarms after a resume
+        delay = MAX_SLEEP
+        if next_alarm is not None:
+            delay = min(delay, max(0, (
+                        next_alarm - dt.datetime.now(LOCAL_TZ)
+                        ).total_seconds()))
+        logging.debug(f'Next alarm at {next_alarm}, sleeping {delay}s')
+        wakeup.clear()
+        try:
+            await asyncio.wait_for(wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
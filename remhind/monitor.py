@@ -1,50 +1,257 @@
 import asyncio
 import logging
+import os
 import os.path
 import pathlib
 
 import aionotify
+import toml
 
 ALL_EVENTS = (
     aionotify.Flags.CREATE
     | aionotify.Flags.DELETE
     | aionotify.Flags.MOVED_FROM
     | aionotify.Flags.MOVED_TO
-    | aionotify.Flags.MODIFY)
+    | aionotify.Flags.MODIFY
+    | aionotify.Flags.CLOSE_WRITE)
+NEW_DIRECTORY = aionotify.Flags.CREATE | aionotify.Flags.MOVED_TO
+QUIET_PERIOD = 1
 
 
-async def get_watchers(config_calendars):
-    watchers = []
-    loop = asyncio.get_event_loop()
+def _calendar_roots(config_calendars):
+    roots = {}
     for calendar in config_calendars.values():
-        path = pathlib.Path(calendar['path'])
-        watcher = aionotify.Watcher()
-        watcher.watch(str(path.expanduser()), flags=ALL_EVENTS)
-        await watcher.setup(loop)
-        logging.info(f'Watcher setup for {path}')
-        watchers.append(watcher)
-    return watchers
-
-
-async def monitor_calendars(config_calendars, calendar_store):
-    watchers = await get_watchers(config_calendars)
-    while True:
-        done, pending = await asyncio.wait(
-            [w.get_event() for w in watchers],
-            return_when=asyncio.FIRST_COMPLETED)
-        for task in done:
-            event = await task
+        path = str(pathlib.Path(calendar['path']).expanduser())
+        roots[path] = roots.get(path, False) or bool(
+            calendar.get('recursive', False))
+    return roots
+
+
+def _is_hidden(path, root):
+    # The calendar root itself may be hidden, only the directories below it
+    # are checked
+    relative = pathlib.PurePath(os.path.relpath(path, root))
+    return any(part.startswith('.') for part in relative.parts)
+
+
+def _iter_directories(path, recursive, root=None):
+    # Hidden directories are skipped, as when indexing the calendars
+    if root is not None and _is_hidden(path, root):
+        return
+    yield path
+    if not recursive:
+        return
+    for dirpath, dirnames, _ in os.walk(path):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for dirname in dirnames:
+            yield os.path.join(dirpath, dirname)
+
+
+# All the calendar directories are watched by a single inotify instance,
+# recursive calendars add a watch for each of their subdirectories.
+class CalendarWatcher:
+
+    def __init__(self, config_dir=None):
+        self.watcher = aionotify.Watcher()
+        self.config_dir = config_dir
+        self.roots = {}
+        # Watched directory -> calendar root it belongs to
+        self.directories = {}
+        if config_dir is not None:
+            self._watch(config_dir)
+
+    async def setup(self):
+        await self.watcher.setup(asyncio.get_running_loop())
+
+    def close(self):
+        if not self.watcher.closed:
+            self.watcher.close()
+
+    def get_event(self):
+        return self.watcher.get_event()
+
+    def _watch(self, path):
+        if path in self.watcher.requests:
+            return
+        try:
+            self.watcher.watch(path, flags=ALL_EVENTS)
+        except OSError:
+            # The request is kept by aionotify even if the watch failed
+            self.watcher.requests.pop(path, None)
+            raise
+        logging.debug(f'Watcher setup for {path}')
+
+    def _unwatch(self, path):
+        if path == self.config_dir or path not in self.watcher.requests:
+            return
+        try:
+            self.watcher.unwatch(path)
+        except OSError:
+            # The kernel already dropped the watch of a removed directory
+            self.forget(path)
+        logging.debug(f'Watcher removed for {path}')
+
+    def forget(self, path):
+        descriptor = self.watcher.descriptors.pop(path, None)
+        self.watcher.requests.pop(path, None)
+        self.watcher.aliases.pop(descriptor, None)
+
+    def is_recursive(self, path):
+        root = self.directories.get(path)
+        return root is not None and self.roots[root]
+
+    def set_calendars(self, config_calendars, strict=False):
+        roots = _calendar_roots(config_calendars)
+        directories = {}
+        # A directory covered by several calendars belongs to a recursive
+        # one, so that the collections created below it are watched
+        for root, recursive in sorted(roots.items(), key=lambda r: r[1]):
+            if self.roots.get(root) == recursive:
+                # The watched directories of an unchanged calendar are kept,
+                # whichever calendar they were attributed to
+                prefix = os.path.join(root, '')
+                covered = [d for d in self.directories if d == root
+                    or (recursive and d.startswith(prefix))]
+            else:
+                covered = _iter_directories(root, recursive)
+            directories.update((d, root) for d in covered)
+
+        for path in self.directories.keys() - directories.keys():
+            self._unwatch(path)
+        for path in directories.keys() - self.directories.keys():
+            try:
+                self._watch(path)
+            except OSError:
+                if strict:
+                    raise
+                self._log_watch_error(path)
+        self.roots, self.directories = roots, directories
+        logging.info(
+            f'Watching {len(self.directories)} directories of'
+            f' {len(self.roots)} calendars')
+
+    def add_directory(self, path, root):
+        for directory in _iter_directories(path, True, root):
+            try:
+                self._watch(directory)
+            except OSError:
+                self._log_watch_error(directory)
+                continue
+            self.directories[directory] = root
+
+    def remove_directory(self, path):
+        prefix = os.path.join(path, '')
+        for directory in list(self.directories):
+            if directory == path or directory.startswith(prefix):
+                self._unwatch(directory)
+                del self.directories[directory]
+
+    def _log_watch_error(self, path):
+        # aionotify does not report the errno, running out of watches is the
+        # usual cause for an existing directory
+        logging.error(
+            f'Could not watch {path}, check that it exists and the'
+            ' fs.inotify.max_user_watches sysctl')
+
+
+async def get_watcher(config_calendars, config_path=None):
+    config_dir = None if config_path is None else str(config_path.parent)
+    watcher = CalendarWatcher(config_dir)
+    watcher.set_calendars(config_calendars, strict=True)
+    await watcher.setup()
+    return watcher
+
+
+async def monitor_calendars(
+        config_calendars, calendar_store, quiet_period=QUIET_PERIOD,
+        config_path=None):
+    loop = asyncio.get_running_loop()
+    if config_path is not None:
+        config_path = pathlib.Path(config_path).expanduser().absolute()
+    watcher = await get_watcher(config_calendars, config_path)
+    # Files are only synchronized once no event was received for them
+    # during the quiet period, so that bursts of events are coalesced
+    pending = {}
+    running = set()
+
+    async def sync_file(path):
+        try:
+            await calendar_store.sync_file(path)
+        except Exception:
+            logging.exception(f'Could not synchronize events from {path}')
+
+    async def rescan_directory(path):
+        try:
+            await calendar_store.rescan(path)
+        except Exception:
+            logging.exception(f'Could not synchronize events from {path}')
+
+    async def reload_config(path):
+        logging.info(f'Reloading configuration from {path}')
+        try:
+            with path.open() as fd:
+                config_calendars = toml.load(fd)['calendars']
+            # Invalid calendars are reported before anything is changed
+            _calendar_roots(config_calendars)
+        except (OSError, KeyError, AttributeError, TypeError,
+                toml.TomlDecodeError):
+            logging.exception(f'Could not reload configuration from {path}')
+            return
+
+        # Only the watches and the events of the calendars which were added
+        # or removed are updated, the events are left alone if the watches
+        # could not be updated
+        try:
+            watcher.set_calendars(config_calendars)
+        except Exception:
+            logging.exception('Could not update the watched calendars')
+            return
+        try:
+            await calendar_store.set_sources(list(config_calendars.values()))
+        except Exception:
+            logging.exception('Could not update the calendars')
+
+    def run_pending(path, handler):
+        del pending[path]
+        task = loop.create_task(handler(path))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    try:
+        while True:
+            event = await watcher.get_event()
+            if event is None:
+                break
             path = pathlib.Path(event.alias) / event.name
             logging.debug(f'Received inotify event for {path}')
-            if os.path.splitext(path)[1] != '.ics':
+            if event.flags & aionotify.Flags.IGNORED:
+                if event.alias in watcher.directories:
+                    watcher.forget(event.alias)
+                continue
+            elif path == config_path:
+                handler = reload_config
+            elif event.alias not in watcher.directories:
+                continue
+            elif event.flags & aionotify.Flags.ISDIR:
+                if (event.name.startswith('.')
+                        or not watcher.is_recursive(event.alias)):
+                    continue
+                if event.flags & NEW_DIRECTORY:
+                    watcher.add_directory(
+                        str(path), watcher.directories[event.alias])
+                else:
+                    watcher.remove_directory(str(path))
+                # Files may have been written before the watch was setup
+                handler = rescan_directory
+            elif os.path.splitext(path)[1] == '.ics':
+                handler = sync_file
+            else:
                 continue
-            if (event.flags & (
-                        aionotify.Flags.CREATE | aionotify.Flags.MOVED_TO)):
-                calendar_store.add_file(path)
-            elif (event.flags & (
-                        aionotify.Flags.DELETE | aionotify.Flags.MOVED_FROM)):
-                calendar_store.remove_file(path)
-            elif event.flags & aionotify.Flags.MODIFY:
-                calendar_store.modify_file(path)
-        for task in pending:
-            task.cancel()
+            if path in pending:
+                pending[path].cancel()
+            pending[path] = loop.call_later(
+                quiet_period, run_pending, path, handler)
+    finally:
+        for handle in pending.values():
+            handle.cancel()
+        watcher.close()
@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+import time
+
+import gi
+
+from .stats import STATS, timer
+
+gi.require_version('Notify', '0.7')
+from gi.repository import Notify  # noqa
+
+QUEUE_SIZE = 256
+GROUP_THRESHOLD = 3
+MAX_RATE = 2
+MAX_GROUP_LINES = 10
+
+
+def show_notification(summary, body):
+    Notify.Notification.new(summary, body).show()
+
+
+class Notifier:
+
+    def __init__(self, group_threshold=GROUP_THRESHOLD, max_rate=MAX_RATE,
+            queue_size=QUEUE_SIZE, show=show_notification):
+        # Alarms due in the same minute are grouped in a single notification
+        # once there are more than group_threshold of them, 0 never groups
+        self.group_threshold = group_threshold
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.show = show
+        self._queue = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.show is show_notification:
+            Notify.init('remhind')
+        self._thread = threading.Thread(
+            target=self._run, name='remhind-notifier', daemon=True)
+        self._stopped.clear()
+        self._thread.start()
+
+    def stop(self):
+        # Pending notifications are discarded
+        if self._thread is None:
+            return
+        self._stopped.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join()
+        self._thread = None
+
+    def _messages(self, alarms):
+        if not self.group_threshold or len(alarms) <= self.group_threshold:
+            for alarm in alarms:
+                yield "{a.due_date:%H:%M} {a.message}".format(a=alarm), "Alarm"
+            return
+
+        lines = ["{a.due_date:%H:%M} {a.message}".format(a=a)
+            for a in alarms[:MAX_GROUP_LINES]]
+        if len(alarms) > MAX_GROUP_LINES:
+            lines.append(f'and {len(alarms) - MAX_GROUP_LINES} more')
+        yield f'{len(alarms)} alarms', '\n'.join(lines)
+
+    def notify(self, alarms):
+        # Never blocks the caller, messages are dropped when the queue is full
+        for summary, body in self._messages(alarms):
+            try:
+                self._queue.put_nowait((summary, body))
+            except queue.Full:
+                logging.warning(
+                    f'Notification queue full, dropping "{summary}"')
+                STATS.increment('notifications.dropped')
+
+    def _run(self):
+        last_shown = None
+        while True:
+            message = self._queue.get()
+            if last_shown is not None:
+                self._stopped.wait(
+                    last_shown + self.min_interval - time.monotonic())
+            if message is None or self._stopped.is_set():
+                break
+            summary, body = message
+            logging.debug(f'Showing notification "{summary}"')
+            try:
+                with timer('notify'):
+                    self.show(summary, body)
+            except Exception:
+                logging.exception(f'Could not show notification "{summary}"')
+            last_shown = time.monotonic()
+            STATS.increment('notifications')
@@ -0,0 +1,129 @@
+import bisect
+import functools
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+
+class _Timer:
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        if self.stats.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.stats.enabled:
+            self.stats.record(self.name, time.perf_counter() - self.start)
+
+
+class Stats:
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def record(self, name, duration):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(duration)
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def timed(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        with self._lock:
+            lines = []
+            for name, histogram in sorted(self.histograms.items()):
+                mean = histogram.total / histogram.count
+                lines.append(
+                    f'{name}: count={histogram.count}'
+                    f' total={histogram.total:.6f}s mean={mean:.6f}s'
+                    f' max={histogram.max:.6f}s')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{name}: {value}')
+            return lines
+
+    def metrics(self):
+        # Prometheus text exposition format
+        with self._lock:
+            lines = []
+            for name, histogram in sorted(self.histograms.items()):
+                metric = 'remhind_' + name.replace('.', '_') + '_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                cumulated = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulated += count
+                    bound = '+Inf' if bound == float('inf') else bound
+                    lines.append(
+                        f'{metric}_bucket{{le="{bound}"}} {cumulated}')
+                lines.append(f'{metric}_sum {histogram.total}')
+                lines.append(f'{metric}_count {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                metric = 'remhind_' + name.replace('.', '_') + '_total'
+                lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric} {value}')
+            return '\n'.join(lines) + '\n'
+
+    def write_metrics(self, path):
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_text(self.metrics())
+        os.replace(tmp_path, path)
+
+
+STATS = Stats()
+timer = STATS.timer
+timed = STATS.timed
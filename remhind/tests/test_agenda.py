@@ -0,0 +1,68 @@
+import datetime as dt
+import unittest
+
+import pytz
+
+from ..agenda import format_alarm, get_agenda, get_next_alarms, parse_date
+from ..db import SQLiteDB
+
+
+class TestAgenda(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLiteDB()
+        self.addCleanup(self.db.close)
+        self.start = dt.datetime(2019, 3, 10, 12, 0, tzinfo=pytz.UTC)
+        meeting = self.start + dt.timedelta(hours=3)
+        self.db.add_alarms([
+                ('meeting', meeting - dt.timedelta(minutes=30), meeting,
+                    'Meeting Reminder', False, 0),
+                ('meeting', meeting, meeting, 'Meeting', False, 0),
+                ('todo', self.start, self.start + dt.timedelta(hours=5),
+                    'Todo', True, 0),
+                ])
+
+    def test_agenda(self):
+        firings = get_agenda(
+            self.db, self.start, self.start + dt.timedelta(days=2))
+        self.assertEqual(
+            [(d.astimezone(pytz.UTC).strftime('%d %H:%M'), a.message)
+                for d, a in firings],
+            [
+                ('10 14:30', 'Meeting Reminder'),
+                ('10 15:00', 'Meeting'),
+                ('10 17:00', 'Todo'),
+                ('11 17:00', 'Todo'),
+                ])
+
+        self.assertEqual(get_agenda(
+                self.db, self.start, self.start + dt.timedelta(hours=1)), [])
+
+    def test_next_alarms(self):
+        firings = get_next_alarms(self.db, self.start, 3)
+        self.assertEqual(
+            [a.message for _, a in firings],
+            ['Meeting Reminder', 'Meeting', 'Todo'])
+
+        firings = get_next_alarms(
+            self.db, self.start + dt.timedelta(days=1), 2)
+        self.assertEqual(
+            [(d.astimezone(pytz.UTC).day, a.message) for d, a in firings],
+            [(11, 'Todo'), (12, 'Todo')])
+
+        self.db.set_done('todo', 'COMPLETED', 0)
+        self.assertEqual(get_next_alarms(
+                self.db, self.start + dt.timedelta(days=1)), [])
+
+    def test_format(self):
+        (date, alarm), = get_next_alarms(self.db, self.start)
+        self.assertEqual(
+            format_alarm(date.astimezone(pytz.UTC), alarm, '{date:%H:%M}'
+                ' {due_date.minute} {message} ({event})'),
+            '14:30 0 Meeting Reminder (meeting)')
+
+    def test_parse_date(self):
+        self.assertEqual(
+            parse_date('2019-03-10T12:00+01:00'),
+            dt.datetime(2019, 3, 10, 11, 0, tzinfo=pytz.UTC))
+        self.assertIsNotNone(parse_date('2019-03-10').tzinfo)
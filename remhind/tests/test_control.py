@@ -0,0 +1,98 @@
+import asyncio
+import datetime as dt
+import pathlib
+import socket
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from freezegun import freeze_time
+
+from ..control import ControlError, ControlHandler, is_listening, request
+from ..events import AsyncCalendarStore
+
+VEVENT = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:remhind
+BEGIN:VEVENT
+UID:20190310
+DTSTAMP:20190310T150000Z
+DTSTART:20190310T150000Z
+DTEND:20190310T160000Z
+SUMMARY:Breakfast Meeting
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class TestControl(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = pathlib.Path(tmp_dir.name)
+        self.cal_path = self.tmp_path / 'calendar'
+        self.cal_path.mkdir()
+        self.store = await AsyncCalendarStore.open(
+            [{'name': 'Test', 'path': str(self.cal_path)}],
+            self.tmp_path / 'remhind.db', workers=1)
+        self.addAsyncCleanup(self.store.close)
+
+        self.socket_path = self.tmp_path / 'remhind.sock'
+        server = await asyncio.start_unix_server(
+            ControlHandler(self.store), path=str(self.socket_path))
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+
+    def request(self, command, **params):
+        return asyncio.to_thread(
+            request, self.socket_path, command, **params)
+
+    async def test_rescan_and_next(self):
+        (self.cal_path / 'event.ics').write_text(VEVENT)
+        self.assertIsNone(await self.request('rescan'))
+
+        with freeze_time('2019-03-10 12:00:00'):
+            alarms = await self.request('next', count=2)
+        self.assertEqual(len(alarms), 1)
+        self.assertEqual(alarms[0]['message'], 'Breakfast Meeting')
+        self.assertEqual(
+            dt.datetime.fromisoformat(alarms[0]['date']),
+            dt.datetime(2019, 3, 10, 15, 0, tzinfo=dt.timezone.utc))
+
+        (self.cal_path / 'event.ics').unlink()
+        await self.request('rescan', path=str(self.cal_path / 'event.ics'))
+        with freeze_time('2019-03-10 12:00:00'):
+            self.assertEqual(await self.request('next'), [])
+
+    async def test_stats_and_flush(self):
+        with patch.object(self.store.store, 'flush_caches') as flush_mock:
+            self.assertIsNone(await self.request('flush'))
+            flush_mock.assert_called_once_with()
+
+        stats = await self.request('stats')
+        self.assertEqual(set(stats), {'enabled', 'summary'})
+
+    async def test_errors(self):
+        with self.assertRaisesRegex(ControlError, 'invalid request'):
+            await self.request('unknown')
+        with self.assertRaisesRegex(ControlError, 'invalid request'):
+            await self.request('next', unknown=1)
+        with self.assertRaises(ControlError) as context:
+            await self.request('rescan', path=str(self.tmp_path))
+        self.assertEqual(
+            str(context.exception),
+            f'{self.tmp_path} is not part of a calendar')
+        with self.assertRaisesRegex(ControlError, 'could not connect'):
+            await asyncio.to_thread(
+                request, self.tmp_path / 'missing.sock', 'stats')
+
+    async def test_is_listening(self):
+        self.assertTrue(
+            await asyncio.to_thread(is_listening, self.socket_path))
+        self.assertFalse(is_listening(self.tmp_path / 'missing.sock'))
+
+        stale_path = self.tmp_path / 'stale.sock'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(str(stale_path))
+        self.assertFalse(is_listening(stale_path))
@@ -0,0 +1,247 @@
+import datetime as dt
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+import pytz
+from tzlocal import get_localzone
+
+import remhind.db
+from ..db import Alarm, SQLiteDB, MIGRATIONS
+
+
+def setUpModule():
+    remhind.db.LOCAL_TZ = pytz.timezone('Europe/Brussels')
+
+
+def tearDownModule():
+    remhind.db.LOCAL_TZ = get_localzone()
+
+
+class TestAlarm(unittest.TestCase):
+
+    def test_alarm(self):
+        alarm = Alarm(1, '20190310', 'Message', 1552228200, 1552230000)
+        self.assertIsNone(alarm._date)
+        self.assertEqual(
+            alarm.date, dt.datetime(2019, 3, 10, 14, 30, tzinfo=pytz.UTC))
+        self.assertEqual(
+            alarm.due_date, dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC))
+        self.assertEqual(
+            alarm, Alarm(1, '20190310', 'Message', 1552228200, 1552230000))
+        with self.assertRaises(AttributeError):
+            alarm.other = None
+
+
+class TestSQLiteDB(unittest.TestCase):
+
+    def test_migrate_unversioned_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = pathlib.Path(tmp_dir) / 'remhind.db'
+            conn = sqlite3.connect(db_path)
+            conn.executescript(MIGRATIONS[0])
+            conn.execute(
+                "INSERT INTO events (event, sequence, path)"
+                " VALUES ('20190310', 0, 'calendar.ics')")
+            conn.execute(
+                "INSERT INTO alarms (event, date, due_date, message, vtodo)"
+                " VALUES ('todo', 0, 3600 * 17, 'Todo', 1)")
+            conn.commit()
+            conn.close()
+
+            db = SQLiteDB(db_path)
+            start = dt.datetime(2019, 3, 10, 17, 0, tzinfo=pytz.UTC)
+            self.assertEqual(
+                [a.event for a in db.get_due_todos(
+                        start, start + dt.timedelta(minutes=1))],
+                ['todo'])
+            version, = db._conn.execute('PRAGMA user_version').fetchone()
+            self.assertEqual(version, len(MIGRATIONS))
+            self.assertEqual(db.get_uids('calendar.ics'), {'20190310'})
+            db._conn.close()
+
+            db = SQLiteDB(db_path)
+            self.assertEqual(db.get_uids('calendar.ics'), {'20190310'})
+            db._conn.close()
+
+    def test_migrate_duplicated_alarms(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = pathlib.Path(tmp_dir) / 'remhind.db'
+            conn = sqlite3.connect(db_path)
+            for script in MIGRATIONS[:2]:
+                conn.executescript(script)
+            conn.execute('PRAGMA user_version = 2')
+            for _ in range(3):
+                conn.execute(
+                    "INSERT INTO alarms (event, date, due_date, message)"
+                    " VALUES ('20190310', 0, 0, 'Message')")
+            conn.commit()
+            conn.close()
+
+            db = SQLiteDB(db_path)
+            count, = db._conn.execute(
+                'SELECT COUNT(*) FROM alarms').fetchone()
+            self.assertEqual(count, 1)
+            db._conn.close()
+
+    def test_indexed_queries(self):
+        db = SQLiteDB()
+        queries = [
+            ("SELECT id, event, message, date, due_date FROM alarms"
+                " WHERE (date >= ?) AND (date < ?) AND (vtodo = 0)", (0, 1)),
+            ("SELECT id, event, message, date, due_date FROM alarms"
+                " WHERE (date < ?) AND (vtodo = 1) AND (done = 0)", (0,)),
+            ("SELECT id, event, message, date, due_date"
+                " FROM alarms INDEXED BY alarms_todo_minute"
+                " WHERE (due_minute >= ?) AND (due_minute < ?)"
+                " AND (date < ?) AND (vtodo = 1) AND (done = 0)", (0, 1, 0)),
+            ("UPDATE alarms SET done=1 WHERE event=? AND sequence<?",
+                ('20190310', 0)),
+            ("DELETE FROM alarms WHERE event = ?", ('20190310',)),
+            ("SELECT event FROM events WHERE path=?", ('calendar.ics',)),
+            ]
+        for query, params in queries:
+            with self.subTest(query=query):
+                plan = db._conn.execute(
+                    'EXPLAIN QUERY PLAN ' + query, params).fetchall()
+                self.assertTrue(all('INDEX' in p[-1] for p in plan), plan)
+
+    def test_add_alarms(self):
+        db = SQLiteDB()
+        date = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        db.add_alarms([
+                ('20190310', date, date, 'Message', False, 0),
+                ('20190310', date, date, 'Message', False, 0),
+                ('20190310', date, date, 'Other message', False, 0),
+                ])
+        db.add_alarm('20190310', date, date, 'Message', False, 0)
+
+        alarms = db.get_alarms(date, date + dt.timedelta(minutes=1))
+        self.assertEqual(
+            sorted(a.message for a in alarms), ['Message', 'Other message'])
+
+    def test_due_todos_around_midnight(self):
+        db = SQLiteDB()
+        for hour, minute in [(23, 59), (0, 0), (0, 1), (12, 0)]:
+            due_date = dt.datetime(2019, 3, 10, hour, minute, tzinfo=pytz.UTC)
+            db.add_alarm(
+                f'{hour}:{minute}', due_date, due_date, 'Todo', True, 0)
+
+        start = dt.datetime(2019, 3, 20, 23, 59, tzinfo=pytz.UTC)
+        for end, expected in [
+                (start, []),
+                (start + dt.timedelta(minutes=1), ['23:59']),
+                (start + dt.timedelta(minutes=2), ['0:0', '23:59']),
+                (start + dt.timedelta(days=1),
+                    ['0:0', '0:1', '12:0', '23:59']),
+                ]:
+            with self.subTest(end=end):
+                self.assertEqual(
+                    sorted(a.event for a in db.get_due_todos(start, end)),
+                    expected)
+
+    def test_next_alarm_date(self):
+        db = SQLiteDB()
+        date = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        self.assertIsNone(db.get_next_alarm_date(date))
+
+        db.add_alarm('event', date, date, 'Event', False, 0)
+        self.assertEqual(db.get_next_alarm_date(date), date)
+        self.assertEqual(
+            db.get_next_alarm_date(date - dt.timedelta(days=1)), date)
+        self.assertIsNone(
+            db.get_next_alarm_date(date + dt.timedelta(minutes=1)))
+
+    def test_next_todo_alarm_date(self):
+        db = SQLiteDB()
+        due_date = dt.datetime(2019, 3, 10, 17, 0, 30, tzinfo=pytz.UTC)
+        db.add_alarm(
+            'todo', due_date - dt.timedelta(days=2), due_date, 'Todo', True,
+            0)
+
+        for after, expected in [
+                (dt.datetime(2019, 3, 1, 0, 0), (3, 8, 17, 0)),
+                (dt.datetime(2019, 3, 8, 17, 0), (3, 8, 17, 0)),
+                (dt.datetime(2019, 3, 8, 17, 1), (3, 9, 17, 0)),
+                (dt.datetime(2019, 3, 20, 18, 0), (3, 21, 17, 0)),
+                ]:
+            with self.subTest(after=after):
+                next_alarm = db.get_next_alarm_date(
+                    after.replace(tzinfo=pytz.UTC)).astimezone(pytz.UTC)
+                self.assertEqual(
+                    (next_alarm.month, next_alarm.day, next_alarm.hour,
+                        next_alarm.minute), expected)
+
+        db.set_done('todo', 'COMPLETED', 0)
+        self.assertIsNone(db.get_next_alarm_date(due_date))
+
+    def test_next_todo_alarm_date_reached_later(self):
+        db = SQLiteDB()
+        day = dt.datetime(2019, 3, 10, tzinfo=pytz.UTC)
+        db.add_alarms([
+                ('early', day - dt.timedelta(days=1),
+                    day + dt.timedelta(hours=8), 'Early', True, 0),
+                ('later', day + dt.timedelta(days=1, hours=10),
+                    day + dt.timedelta(hours=11), 'Later', True, 0),
+                ])
+
+        for after, expected in [
+                (dt.timedelta(hours=7), dt.timedelta(hours=8)),
+                (dt.timedelta(hours=9), dt.timedelta(days=1, hours=8)),
+                (dt.timedelta(days=1, hours=9),
+                    dt.timedelta(days=1, hours=11)),
+                ]:
+            with self.subTest(after=after):
+                self.assertEqual(
+                    db.get_next_alarm_date(day + after), day + expected)
+
+    def test_transaction_rollback(self):
+        db = SQLiteDB()
+        date = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.add_event('20190310', 0, 'calendar.ics')
+                with db.transaction():
+                    db.add_alarm('20190310', date, date, 'Message', False, 0)
+                raise ValueError
+
+        self.assertEqual(db.get_uids('calendar.ics'), set())
+        self.assertEqual(
+            db.get_alarms(date, date + dt.timedelta(minutes=1)), [])
+
+    def test_transaction_commit(self):
+        db = SQLiteDB()
+        with db.transaction():
+            db.add_event('20190310', 0, 'calendar.ics')
+            self.assertTrue(db._conn.in_transaction)
+        self.assertFalse(db._conn.in_transaction)
+        self.assertEqual(db.get_uids('calendar.ics'), {'20190310'})
+
+    def test_readonly_connection(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = pathlib.Path(tmp_dir) / 'remhind.db'
+            with self.assertRaises(sqlite3.OperationalError):
+                SQLiteDB(db_path, readonly=True)
+
+            db = SQLiteDB(db_path)
+            self.addCleanup(db.close)
+            journal_mode, = db._conn.execute(
+                'PRAGMA journal_mode').fetchone()
+            self.assertEqual(journal_mode, 'wal')
+            db.add_event('20190310', 0, 'calendar.ics')
+
+            reader = SQLiteDB(db_path, readonly=True)
+            self.addCleanup(reader.close)
+            with db.transaction():
+                db.add_event('other', 0, 'calendar.ics')
+                # Readers are not blocked by the writer
+                self.assertEqual(
+                    reader.get_uids('calendar.ics'), {'20190310'})
+            self.assertEqual(
+                reader.get_uids('calendar.ics'), {'20190310', 'other'})
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.add_event('20190310', 1, 'calendar.ics')
+
+        with self.assertRaises(ValueError):
+            SQLiteDB(readonly=True)
@@ -1,14 +1,22 @@
+import asyncio
 import datetime as dt
+import pathlib
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, Mock, call, patch
 
 import icalendar
 import pytz
 from tzlocal import get_localzone
 from freezegun import freeze_time
 
+import remhind.db
 import remhind.events
-from ..events import EventCollection, parse_rule, get_component_from_ics
+from ..events import (
+    AsyncCalendarStore, CalendarStore, ComponentCache, EventCollection,
+    check_events, iter_calendar_components, parse_rule,
+    get_component_from_ics)
 
 VEVENT = """
 BEGIN:VEVENT
@@ -170,6 +178,18 @@ END:VALARM
 END:VEVENT
 """
 
+VTIMEZONE = """
+BEGIN:VTIMEZONE
+TZID:Custom Zone
+BEGIN:STANDARD
+DTSTART:19701025T030000
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0500
+TZNAME:CZ
+END:STANDARD
+END:VTIMEZONE
+"""
+
 RRULE_TODO = """
 BEGIN:VTODO
 DTSTAMP:20190114T070828Z
@@ -185,11 +205,18 @@ END:VTODO
 """
 
 
+def renewed(component):
+    # Side effect of a mocked ComponentCache.get_many
+    return lambda uids, ics: dict.fromkeys(uids, component)
+
+
 def setUpModule():
+    remhind.db.LOCAL_TZ = pytz.timezone('Europe/Brussels')
     remhind.events.LOCAL_TZ = pytz.timezone('Europe/Brussels')
 
 
 def tearDownModule():
+    remhind.db.LOCAL_TZ = get_localzone()
     remhind.events.LOCAL_TZ = get_localzone()
 
 
@@ -373,11 +400,10 @@ class TestEventCollection(unittest.TestCase):
             alarms[0].due_date.astimezone(pytz.UTC),
             dt.datetime(2019, 3, 10, 11, 0, tzinfo=pytz.UTC))
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
-    def test_due_alarms(self, path_mock, component_mock):
+    @patch('remhind.events.ComponentCache.get_many')
+    def test_due_alarms(self, component_mock):
         event = icalendar.Event.from_ical(VEVENT_ALARM)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -393,12 +419,32 @@ class TestEventCollection(unittest.TestCase):
         alarms = collection.get_due_alarms(start)
         self.assertEqual(len(alarms), 1)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
+    @patch('remhind.events.ComponentCache.get_many')
+    def test_due_alarms_by_minute(self, component_mock):
+        events = {
+            uid: icalendar.Event.from_ical(VEVENT.replace(
+                    'UID:20190310', f'UID:{uid}').replace(
+                    'DTSTART:20190310T150000Z',
+                    f'DTSTART:20190310T15{minute}00Z'))
+            for uid, minute in [('first', '00'), ('second', '01')]}
+        component_mock.side_effect = (
+            lambda uids, ics: {uid: events[uid] for uid in uids})
+        collection = EventCollection()
+        for event in events.values():
+            collection.add(event, None)
+
+        start = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        self.assertEqual(
+            [[a.event for a in alarms]
+                for alarms in collection.get_due_alarms_by_minute(
+                    start, start + dt.timedelta(minutes=3))],
+            [['first'], ['second'], []])
+
+    @patch('remhind.events.ComponentCache.get_many')
     @freeze_time('20190310', tz_offset=0)
-    def test_due_alarms_reccuring(self, path_mock, component_mock):
+    def test_due_alarms_reccuring(self, component_mock):
         event = icalendar.Event.from_ical(VEVENT_RRULE)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -408,12 +454,39 @@ class TestEventCollection(unittest.TestCase):
                 alarms = collection.get_due_alarms(start)
                 self.assertEqual(len(alarms), 1)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
+    @patch('remhind.events.ComponentCache.get_many')
     @freeze_time('20190310', tz_offset=0)
-    def test_due_todo_with_rrule(self, path_mock, component_mock):
+    def test_due_alarms_sparse_recurrence(self, component_mock):
+        for freq, dates in [
+                ('MONTHLY', [
+                        dt.datetime(2019, month, 10, 15, 0, tzinfo=pytz.UTC)
+                        for month in range(3, 9)]),
+                ('YEARLY', [
+                        dt.datetime(year, 3, 10, 15, 0, tzinfo=pytz.UTC)
+                        for year in range(2019, 2024)]),
+                ]:
+            with self.subTest(freq=freq):
+                event = icalendar.Event.from_ical(
+                    VEVENT_RRULE.replace('FREQ=DAILY', f'FREQ={freq}'))
+                component_mock.side_effect = renewed(event)
+                collection = EventCollection()
+                collection.add(event, None)
+
+                # Each occurence is materialized when the previous one is
+                # notified, beyond the horizon
+                for date in dates:
+                    self.assertEqual(
+                        collection.get_next_alarm_date(
+                            date - dt.timedelta(hours=1)),
+                        date - dt.timedelta(minutes=30))
+                    alarms = collection.get_due_alarms(date)
+                    self.assertEqual(len(alarms), 1)
+
+    @patch('remhind.events.ComponentCache.get_many')
+    @freeze_time('20190310', tz_offset=0)
+    def test_due_todo_with_rrule(self, component_mock):
         event = icalendar.Event.from_ical(VTODO_RRULE)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -426,7 +499,7 @@ class TestEventCollection(unittest.TestCase):
         # Simulate completion and the monitoring of the file
         completed_event = icalendar.Todo.from_ical(
             VTODO_RRULE.replace('NEEDS-ACTION', 'COMPLETED'))
-        component_mock.return_value = completed_event
+        component_mock.side_effect = renewed(completed_event)
         collection.add(completed_event, None)
 
         for day in range(15, 31):
@@ -435,11 +508,10 @@ class TestEventCollection(unittest.TestCase):
                 alarms = collection.get_due_alarms(start)
                 self.assertEqual(len(alarms), 0)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
-    def test_due_todo_without_rrule(self, path_mock, component_mock):
+    @patch('remhind.events.ComponentCache.get_many')
+    def test_due_todo_without_rrule(self, component_mock):
         event = icalendar.Event.from_ical(VTODO)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -452,7 +524,7 @@ class TestEventCollection(unittest.TestCase):
         # Simulate completion and the monitoring of the file
         completed_event = icalendar.Todo.from_ical(
             VTODO.replace('NEEDS-ACTION', 'COMPLETED'))
-        component_mock.return_value = completed_event
+        component_mock.side_effect = renewed(completed_event)
         collection.add(completed_event, None)
 
         for day in range(15, 31):
@@ -461,6 +533,87 @@ class TestEventCollection(unittest.TestCase):
                 alarms = collection.get_due_alarms(start)
                 self.assertEqual(len(alarms), 0)
 
+    @patch('remhind.events.ComponentCache.get_many')
+    def test_due_alarms_timeline(self, component_mock):
+        event = icalendar.Event.from_ical(VEVENT_ALARM)
+        component_mock.side_effect = renewed(event)
+        collection = EventCollection()
+        collection.add(event, None)
+
+        start = dt.datetime(2019, 3, 10, 14, 0, tzinfo=pytz.UTC)
+        self.assertEqual(
+            collection.get_next_alarm_date(start).astimezone(pytz.UTC),
+            dt.datetime(2019, 3, 10, 14, 30, tzinfo=pytz.UTC))
+
+        found = collection.get_due_alarms(start)
+        with patch.object(collection.db, 'get_event_alarms',
+                wraps=collection.db.get_event_alarms) as query_mock:
+            for minute in range(1, 30):
+                date = start + dt.timedelta(minutes=minute)
+                found.extend(collection.get_due_alarms(date))
+            self.assertEqual(query_mock.call_count, 0)
+            found.extend(collection.get_due_alarms(
+                    start + dt.timedelta(minutes=30)))
+        self.assertEqual(
+            [a.message for a in found], ['Breakfast Meeting Reminder'])
+
+        collection.add(icalendar.Event.from_ical(
+                VEVENT.replace('UID:20190310', 'UID:other')), None)
+        alarms = collection.get_due_alarms(
+            dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC))
+        self.assertEqual(
+            sorted(a.message for a in alarms),
+            ['Annual Employee Review', 'Breakfast Meeting'])
+
+        collection.remove('None')
+        alarms = collection.get_due_alarms(
+            dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC))
+        self.assertEqual(alarms, [])
+
+    @patch('remhind.events.ComponentCache.get_many')
+    @freeze_time('20190310', tz_offset=0)
+    def test_rule_cache(self, component_mock):
+        event = icalendar.Event.from_ical(VEVENT_RRULE)
+        component_mock.side_effect = renewed(event)
+        collection = EventCollection()
+
+        with patch('remhind.events.parse_rule',
+                wraps=remhind.events.parse_rule) as parse_mock:
+            collection.add(event, None)
+            for day in range(15, 31):
+                start = dt.datetime(2019, 3, day, 15, 0, tzinfo=pytz.UTC)
+                collection.get_due_alarms(start)
+            self.assertEqual(parse_mock.call_count, 1)
+
+            modified_event = icalendar.Event.from_ical(
+                VEVENT_RRULE.replace('FREQ=DAILY', 'FREQ=WEEKLY'))
+            collection.add(modified_event, None)
+            self.assertEqual(parse_mock.call_count, 2)
+
+            collection.remove('None')
+            collection.add(modified_event, None)
+            self.assertEqual(parse_mock.call_count, 3)
+
+    @freeze_time('20190310', tz_offset=0)
+    def test_recurrence_horizon(self):
+        start = dt.datetime(2019, 3, 10, 0, 0, tzinfo=pytz.UTC)
+        end = dt.datetime(2030, 1, 1, 0, 0, tzinfo=pytz.UTC)
+        for freq, horizon, expected in [
+                ('YEARLY', dt.timedelta(days=7), 1),
+                ('DAILY', dt.timedelta(days=7), 8),
+                ('HOURLY', dt.timedelta(days=1), 25),
+                ('MINUTELY', dt.timedelta(days=7), 50),
+                ]:
+            with self.subTest(freq=freq):
+                event = icalendar.Event.from_ical(
+                    VEVENT.replace('CLASS', f'RRULE:FREQ={freq}\nCLASS'))
+                collection = EventCollection(
+                    horizon=horizon, max_occurences=50)
+                collection.add(event, None)
+
+                alarms = collection.db.get_alarms(start, end)
+                self.assertEqual(len(alarms), expected)
+
     def test_todo_no_start(self):
         event = icalendar.Todo.from_ical(VTODO_NO_DATE)
         collection = EventCollection()
@@ -472,12 +625,11 @@ class TestEventCollection(unittest.TestCase):
 
         self.assertEqual(len(alarms), 0)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
+    @patch('remhind.events.ComponentCache.get_many')
     @freeze_time('20190310', tz_offset=0)
-    def test_long_overdue_todo(self, path_mock, component_mock):
+    def test_long_overdue_todo(self, component_mock):
         event = icalendar.Todo.from_ical(VTODO_LONG_OVERDUE)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -491,19 +643,18 @@ class TestEventCollection(unittest.TestCase):
 
         completed_event = icalendar.Todo.from_ical(
             VTODO_LONG_OVERDUE.replace('NEEDS-ACTION', 'COMPLETED'))
-        component_mock.return_value = completed_event
+        component_mock.side_effect = renewed(completed_event)
         collection.add(completed_event, None)
 
         alarms = collection.get_due_alarms(tea_time)
         self.assertEqual(len(alarms), 0)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
+    @patch('remhind.events.ComponentCache.get_many')
     @freeze_time('20190310', tz_offset=0)
     def test_due_todo_with_rrule_complete_some(
-            self, path_mock, component_mock):
+            self, component_mock):
         event = icalendar.Event.from_ical(VTODO_RRULE)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -515,7 +666,7 @@ class TestEventCollection(unittest.TestCase):
 
         completed_event = icalendar.Todo.from_ical(
             VTODO_RRULE.replace('SEQUENCE:0', 'SEQUENCE:5'))
-        component_mock.return_value = completed_event
+        component_mock.side_effect = renewed(completed_event)
         collection.add(completed_event, None)
 
         alarms = collection.get_due_alarms(start)
@@ -527,12 +678,11 @@ class TestEventCollection(unittest.TestCase):
                 alarms = collection.get_due_alarms(start)
                 self.assertEqual(len(alarms), idx + 1)
 
-    @patch('remhind.events.get_component_from_ics')
-    @patch('pathlib.Path.read_text')
+    @patch('remhind.events.ComponentCache.get_many')
     @freeze_time('20190310', tz_offset=0)
-    def test_due_todo_with_sequence(self, path_mock, component_mock):
+    def test_due_todo_with_sequence(self, component_mock):
         event = icalendar.Event.from_ical(VTODO_STARTING_SEQUENCE)
-        component_mock.return_value = event
+        component_mock.side_effect = renewed(event)
         collection = EventCollection()
         collection.add(event, None)
 
@@ -544,7 +694,7 @@ class TestEventCollection(unittest.TestCase):
 
         completed_event = icalendar.Todo.from_ical(
             VTODO_STARTING_SEQUENCE.replace('SEQUENCE:2', 'SEQUENCE:4'))
-        component_mock.return_value = completed_event
+        component_mock.side_effect = renewed(completed_event)
         collection.add(completed_event, None)
 
         nbr_alarms = idx + 1 - 2
@@ -556,3 +706,601 @@ class TestEventCollection(unittest.TestCase):
             with self.subTest(start):
                 alarms = collection.get_due_alarms(start)
                 self.assertEqual(len(alarms), nbr_alarms + idx + 1)
+
+
+class TestCalendarStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = pathlib.Path(tmp_dir.name)
+        self.cal_path = self.tmp_path / 'calendar'
+        self.cal_path.mkdir()
+        self.db_path = self.tmp_path / 'remhind.db'
+        self.sources = [{'name': 'Test', 'path': str(self.cal_path)}]
+
+    def write_ics(self, name, component):
+        ics = self.cal_path / name
+        ics.write_text(
+            'BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:remhind\n'
+            + component.strip() + '\nEND:VCALENDAR\n')
+        return ics
+
+    def store(self, workers=1):
+        store = CalendarStore(self.sources, self.db_path, workers=workers)
+        self.addCleanup(store.events.db._conn.close)
+        return store
+
+    def test_startup_skips_unchanged_files(self):
+        self.write_ics('event.ics', VEVENT_ALARM)
+        self.write_ics('todo.ics', VTODO.replace('UID:20190310', 'UID:todo'))
+        self.store()
+
+        with patch('remhind.events.iter_calendar_components') as parse_mock:
+            store = self.store()
+            parse_mock.assert_not_called()
+        self.assertEqual(
+            store.events.db.get_uids(self.cal_path / 'event.ics'),
+            {'20190310'})
+
+    def test_startup_reindexes_changed_and_removed_files(self):
+        event_ics = self.write_ics('event.ics', VEVENT_ALARM)
+        todo_ics = self.write_ics(
+            'todo.ics', VTODO.replace('UID:20190310', 'UID:todo'))
+        self.store()
+
+        self.write_ics('event.ics', VEVENT_ALARM.replace(
+                'SUMMARY:Breakfast Meeting', 'SUMMARY:Brunch Meeting'))
+        todo_ics.unlink()
+        store = self.store()
+
+        start = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        alarms = store.events.db.get_alarms(
+            start, start + dt.timedelta(minutes=1))
+        self.assertIn('Brunch Meeting', {a.message for a in alarms})
+        self.assertEqual(store.events.db.get_uids(todo_ics), set())
+        self.assertEqual(
+            set(store.events.db.get_fingerprints(self.cal_path)),
+            {str(event_ics)})
+
+    def test_startup_renews_stale_events(self):
+        self.write_ics('event.ics', VEVENT_RRULE)
+        self.write_ics('other.ics', VEVENT.replace('UID:20190310', 'UID:once'))
+        with freeze_time('20261001', tz_offset=0):
+            self.store()
+        with freeze_time('20261020', tz_offset=0):
+            store = self.store()
+
+        start = dt.datetime(2026, 10, 20, 14, 30, tzinfo=pytz.UTC)
+        self.assertEqual(
+            store.events.get_next_alarm_date(start),
+            start.astimezone(remhind.events.LOCAL_TZ))
+        self.assertEqual(
+            [a.message for a in store.events.get_due_alarms(start)],
+            ['Breakfast Meeting Reminder'])
+
+        with freeze_time('20261021', tz_offset=0), patch(
+                'remhind.events._parse_calendar_file') as parse_mock:
+            self.store()
+            parse_mock.assert_not_called()
+
+    def test_startup_worker_pool(self):
+        for idx in range(8):
+            self.write_ics(
+                f'event{idx}.ics',
+                VEVENT_ALARM.replace('UID:20190310', f'UID:event{idx}'))
+        store = self.store(workers=2)
+
+        for idx in range(8):
+            with self.subTest(idx=idx):
+                self.assertEqual(
+                    store.events.db.get_uids(
+                        self.cal_path / f'event{idx}.ics'),
+                    {f'event{idx}'})
+
+    @patch('remhind.events.LARGE_CALENDAR_SIZE', 2048)
+    def test_startup_worker_pool_large_file(self):
+        for idx in range(4):
+            self.write_ics(
+                f'event{idx}.ics',
+                VEVENT_ALARM.replace('UID:20190310', f'UID:event{idx}'))
+        large_ics = self.write_ics('large.ics', ''.join(
+                VEVENT.replace('UID:20190310', f'UID:large{idx}')
+                for idx in range(20)))
+
+        pooled = []
+        parse_pooled = CalendarStore._parse_pooled
+
+        def record_pooled(store, files):
+            pooled.extend(files)
+            return parse_pooled(store, files)
+
+        with patch.object(CalendarStore, '_parse_pooled', autospec=True,
+                side_effect=record_pooled):
+            store = self.store(workers=2)
+        self.assertEqual(len(pooled), 4)
+        self.assertNotIn(large_ics, pooled)
+        self.assertEqual(len(store.events.db.get_uids(large_ics)), 20)
+        self.assertEqual(
+            store.events.db.get_uids(self.cal_path / 'event0.ics'),
+            {'event0'})
+
+    def test_sync_file(self):
+        store = self.store()
+        ics = self.write_ics('event.ics', VEVENT_ALARM)
+        with patch.object(store, 'index_file', wraps=store.index_file) as (
+                index_mock):
+            store.sync_file(ics)
+            store.sync_file(ics)
+            index_mock.assert_called_once()
+        self.assertEqual(store.events.db.get_uids(ics), {'20190310'})
+
+        self.write_ics('event.ics', VEVENT_ALARM.replace(
+                'SUMMARY:Breakfast Meeting', 'SUMMARY:Brunch Meeting'))
+        with patch.object(store, 'index_file') as index_mock:
+            store.sync_file(ics)
+            index_mock.assert_called_once()
+            self.assertEqual(index_mock.call_args.args[0][0], ics)
+
+        ics.unlink()
+        store.sync_file(ics)
+        self.assertEqual(store.events.db.get_uids(ics), set())
+        self.assertIsNone(store.events.db.get_fingerprint(ics))
+
+    def test_modify_file_diff(self):
+        other = VEVENT.replace('UID:20190310', 'UID:other')
+        gone = VEVENT.replace('UID:20190310', 'UID:gone')
+        ics = self.write_ics('events.ics', VEVENT_ALARM + other + gone)
+        store = self.store()
+
+        self.write_ics('events.ics', VEVENT_ALARM.replace(
+                'SUMMARY:Breakfast Meeting', 'SUMMARY:Brunch Meeting')
+            .replace('T150000Z', 'T140000Z') + other)
+        with patch.object(store.events, 'add', wraps=store.events.add) as (
+                add_mock):
+            store.modify_file(ics)
+            self.assertEqual(
+                [str(c.args[0]['uid']) for c in add_mock.call_args_list],
+                ['20190310'])
+        self.assertEqual(store.events.db.get_uids(ics), {'20190310', 'other'})
+
+        start = dt.datetime(2019, 3, 10, 14, 0, tzinfo=pytz.UTC)
+        alarms = store.events.db.get_alarms(
+            start, start + dt.timedelta(hours=2))
+        self.assertEqual(
+            sorted((a.event, a.message) for a in alarms),
+            [
+                ('20190310', 'Brunch Meeting'),
+                ('other', 'Annual Employee Review'),
+                ])
+
+        with patch.object(store.events, 'add') as add_mock:
+            store.modify_file(ics)
+            add_mock.assert_not_called()
+
+    @patch('remhind.events.LARGE_CALENDAR_SIZE', 0)
+    def test_modify_large_file_diff(self):
+        other = VEVENT.replace('UID:20190310', 'UID:other')
+        ics = self.write_ics('events.ics', VEVENT_ALARM + other)
+        store = self.store()
+        store.events.components = ComponentCache(max_file_size=0)
+
+        self.write_ics('events.ics', VEVENT_ALARM.replace(
+                'SUMMARY:Breakfast Meeting', 'SUMMARY:Brunch Meeting')
+            + other)
+        with patch.object(store.events, 'add', wraps=store.events.add) as (
+                add_mock), patch('remhind.events._parse_block',
+                wraps=remhind.events._parse_block) as parse_mock:
+            store.modify_file(ics)
+            self.assertEqual(
+                [str(c.args[0]['uid']) for c in add_mock.call_args_list],
+                ['20190310'])
+            # Both components are hashed, only the changed one is added
+            self.assertEqual(parse_mock.call_count, 3)
+        self.assertEqual(store.events.components._cache, {})
+
+        start = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC)
+        alarms = store.events.db.get_alarms(
+            start, start + dt.timedelta(minutes=1))
+        self.assertEqual(
+            sorted(a.message for a in alarms),
+            ['Annual Employee Review', 'Brunch Meeting'])
+
+    @patch('remhind.events.LARGE_CALENDAR_SIZE', 0)
+    @patch('remhind.events.INDEX_BATCH_SIZE', 3)
+    def test_index_large_file_batches(self):
+        store = self.store()
+        store.events.components = ComponentCache(max_file_size=0)
+        ics = self.write_ics('events.ics', ''.join(
+                VEVENT.replace('UID:20190310', f'UID:event{idx}')
+                for idx in range(10)))
+
+        batches = []
+        index_file = store.index_file
+
+        def record_batch(parsed):
+            # Components parsed so far, the first ten were only hashed
+            batches.append((len(parsed[5]), parse_mock.call_count))
+            self.assertIsNone(store.events.db.get_fingerprint(ics))
+            return index_file(parsed)
+
+        with patch('remhind.events._parse_block',
+                wraps=remhind.events._parse_block) as parse_mock, (
+                patch.object(store, 'index_file', record_batch)):
+            store.sync_file(ics)
+        self.assertIsNotNone(store.events.db.get_fingerprint(ics))
+        self.assertEqual([size for size, _ in batches], [3, 3, 3, 1])
+        # The changed components are parsed as they are indexed
+        self.assertEqual(
+            [parsed for _, parsed in batches], [14, 17, 20, 20])
+        self.assertEqual(
+            store.events.db.get_uids(ics), {f'event{i}' for i in range(10)})
+        self.assertNotIn(
+            None, store.events.db.get_event_hashes(ics).values())
+
+    def test_set_sources(self):
+        other_path = self.tmp_path / 'other'
+        other_path.mkdir()
+        event_ics = self.write_ics('event.ics', VEVENT_ALARM)
+        other_ics = other_path / 'other.ics'
+        other_ics.write_text(event_ics.read_text().replace(
+                'UID:20190310', 'UID:other'))
+        store = self.store()
+
+        other_source = {'name': 'Other', 'path': str(other_path)}
+        with patch.object(store, 'index_file', wraps=store.index_file) as (
+                index_mock):
+            store.set_sources(self.sources + [other_source])
+            index_mock.assert_called_once()
+        self.assertEqual(store.events.db.get_uids(other_ics), {'other'})
+
+        store.set_sources([other_source])
+        self.assertEqual(store.events.db.get_uids(event_ics), set())
+        self.assertEqual(store.events.db.get_fingerprints(self.cal_path), {})
+        self.assertEqual(store.events.db.get_uids(other_ics), {'other'})
+        self.assertEqual(store.sources, [other_source])
+
+    def test_set_sources_overlapping(self):
+        work_path = self.cal_path / 'work'
+        work_path.mkdir()
+        work_ics = work_path / 'event.ics'
+        work_ics.write_text(self.write_ics('event.ics', VEVENT_ALARM)
+            .read_text().replace('UID:20190310', 'UID:work'))
+        all_source = {'name': 'All', 'path': str(self.cal_path),
+            'recursive': True}
+        self.sources = [all_source, {'name': 'Work', 'path': str(work_path)}]
+        store = self.store()
+
+        store.set_sources([all_source])
+        self.assertEqual(store.events.db.get_uids(work_ics), {'work'})
+
+    def test_startup_removed_source(self):
+        other_path = self.tmp_path / 'other'
+        other_path.mkdir()
+        event_ics = self.write_ics('event.ics', VEVENT_ALARM)
+        other_ics = other_path / 'other.ics'
+        other_ics.write_text(event_ics.read_text().replace(
+                'UID:20190310', 'UID:other'))
+        sources = self.sources
+        self.sources = sources + [{'name': 'Other', 'path': str(other_path)}]
+        self.store()
+
+        self.sources = sources
+        store = self.store()
+        self.assertEqual(store.events.db.get_uids(other_ics), set())
+        self.assertEqual(store.events.db.get_fingerprints(other_path), {})
+        self.assertEqual(store.events.db.get_files(), {str(event_ics)})
+        self.assertEqual(store.events.db.get_uids(event_ics), {'20190310'})
+
+    def test_recursive_source(self):
+        collection_path = self.cal_path / 'collection' / 'nested'
+        collection_path.mkdir(parents=True)
+        (self.cal_path / '.hidden').mkdir()
+        sibling_path = self.tmp_path / 'calendar-sibling'
+        sibling_path.mkdir()
+        nested_ics = collection_path / 'event.ics'
+        nested_ics.write_text(self.write_ics('event.ics', VEVENT_ALARM)
+            .read_text().replace('UID:20190310', 'UID:nested'))
+        (self.cal_path / '.hidden' / 'event.ics').write_text(
+            nested_ics.read_text().replace('UID:nested', 'UID:hidden'))
+        (sibling_path / 'event.ics').write_text(
+            nested_ics.read_text().replace('UID:nested', 'UID:sibling'))
+        self.sources = [
+            {'name': 'Test', 'path': str(self.cal_path), 'recursive': True},
+            {'name': 'Sibling', 'path': str(sibling_path)},
+            ]
+        store = self.store()
+
+        self.assertEqual(
+            set(store.events.db.get_fingerprints(self.cal_path, True)),
+            {str(self.cal_path / 'event.ics'), str(nested_ics)})
+        self.assertEqual(store.events.db.get_uids(nested_ics), {'nested'})
+
+        nested_ics.unlink()
+        collection_path.rmdir()
+        store.rescan(self.cal_path / 'collection')
+        self.assertEqual(store.events.db.get_uids(nested_ics), set())
+        self.assertEqual(
+            set(store.events.db.get_fingerprints(self.cal_path, True)),
+            {str(self.cal_path / 'event.ics')})
+
+        # Rescanning the calendar covers its collections
+        other_ics = self.cal_path / 'other' / 'event.ics'
+        other_ics.parent.mkdir()
+        other_ics.write_text((self.cal_path / 'event.ics').read_text()
+            .replace('UID:20190310', 'UID:other'))
+        store.rescan(self.cal_path)
+        self.assertEqual(store.events.db.get_uids(other_ics), {'other'})
+
+        hidden_path = self.cal_path / '.hidden'
+        for path in [hidden_path, hidden_path / 'event.ics']:
+            with self.subTest(path=path), self.assertRaises(ValueError):
+                store.rescan(path)
+
+    def test_index_invalid_files(self):
+        store = self.store()
+        collection_path = self.cal_path / 'collection'
+        self.write_ics('invalid.ics', VEVENT_ALARM.replace(
+                'ACTION:DISPLAY\n', ''))
+        ics = self.write_ics('event.ics', VEVENT_ALARM.replace(
+                'UID:20190310', 'UID:other'))
+        with self.assertLogs(level='ERROR') as logs:
+            store.index([
+                    (self.cal_path / 'invalid.ics', {}),
+                    (collection_path / 'removed.ics', {}),
+                    (ics, {}),
+                    ], [])
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(store.events.db.get_uids(ics), {'other'})
+        self.assertEqual(
+            set(store.events.db.get_fingerprints(self.cal_path)), {str(ics)})
+
+    def test_rescan_outside_calendars(self):
+        stray_path = self.tmp_path / 'stray'
+        stray_path.mkdir()
+        (self.cal_path / 'nested').mkdir()
+        ics = self.write_ics('event.ics', VEVENT_ALARM)
+        store = self.store()
+
+        for path in [
+                stray_path, stray_path / 'event.ics',
+                self.cal_path / 'nested',
+                self.cal_path / 'nested' / 'event.ics']:
+            with self.subTest(path=path), self.assertRaises(ValueError):
+                store.rescan(path)
+
+        ics.unlink()
+        store.rescan(self.cal_path)
+        self.assertEqual(store.events.db.get_uids(ics), set())
+
+    def test_component_cache(self):
+        ics = self.write_ics('event.ics', VEVENT_ALARM + VEVENT.replace(
+                'UID:20190310', 'UID:other'))
+        other_ics = self.write_ics('other.ics', VTODO)
+        cache = ComponentCache(maxsize=1)
+
+        with patch('remhind.events._parse_calendar_file',
+                wraps=remhind.events._parse_calendar_file) as parse_mock:
+            components = cache.get_many(['20190310', 'unknown'], ics)
+            self.assertEqual(list(components), ['20190310'])
+            self.assertEqual(
+                components['20190310']['summary'], 'Breakfast Meeting')
+            self.assertEqual(
+                cache.get_many(['other'], ics)['other']['summary'],
+                'Annual Employee Review')
+            self.assertEqual(parse_mock.call_count, 1)
+
+            self.write_ics('event.ics', VEVENT_ALARM.replace(
+                    'SUMMARY:Breakfast Meeting', 'SUMMARY:Brunch Meeting'))
+            self.assertEqual(
+                cache.get_many(['20190310'], ics)['20190310']['summary'],
+                'Brunch Meeting')
+            self.assertEqual(parse_mock.call_count, 2)
+
+            cache.get_many(['20190310'], other_ics)
+            cache.get_many(['20190310'], ics)
+            self.assertEqual(parse_mock.call_count, 4)
+
+    @freeze_time('20190310', tz_offset=0)
+    def test_renewal_parses_file_once(self):
+        self.write_ics('events.ics', VEVENT_RRULE + VEVENT_RRULE.replace(
+                'UID:20190310', 'UID:other'))
+        store = self.store()
+        store.events.components.clear()
+
+        with patch('remhind.events._parse_calendar_file',
+                wraps=remhind.events._parse_calendar_file) as parse_mock:
+            for day in range(10, 31):
+                start = dt.datetime(2019, 3, day, 15, 0, tzinfo=pytz.UTC)
+                with self.subTest(start):
+                    alarms = store.events.get_due_alarms(start)
+                    self.assertEqual(len(alarms), 2)
+            self.assertEqual(parse_mock.call_count, 1)
+
+    @freeze_time('20190310', tz_offset=0)
+    @patch('remhind.events.LARGE_CALENDAR_SIZE', 0)
+    def test_renewal_reads_large_file_once(self):
+        ics = self.write_ics('events.ics', VEVENT_RRULE + VEVENT_RRULE.replace(
+                'UID:20190310', 'UID:other'))
+        store = self.store()
+        store.events.components = ComponentCache(max_file_size=0)
+
+        last = dt.datetime(2019, 3, 17, 15, 0, tzinfo=pytz.UTC)
+        with patch('remhind.events.iter_calendar_components',
+                wraps=remhind.events.iter_calendar_components) as parse_mock:
+            store.events._renew({'20190310': last, 'other': last})
+            parse_mock.assert_called_once_with(ics, {'20190310', 'other'})
+        self.assertEqual(
+            store.events.db.get_last_occurences()['other'],
+            last + dt.timedelta(days=7))
+
+    def test_iter_calendar_components(self):
+        ics = self.write_ics('calendar.ics', '\n'.join([
+                    VEVENT_ALARM,
+                    RRULE_EVENT.replace('Europe/Brussels', 'Custom Zone'),
+                    VTIMEZONE,
+                    VTODO.replace('UID:20190310', 'UID:todo'),
+                    ]))
+
+        with patch('remhind.events.LARGE_CALENDAR_SIZE', 0):
+            components = list(iter_calendar_components(ics))
+        self.assertEqual(
+            [str(c['uid']) for c in components],
+            ['20190310', 'todo', 'BY8RPO6AXKEKM5EFBFN0W9'])
+        self.assertEqual(len(components[0].subcomponents), 1)
+        self.assertEqual(
+            components[2]['dtstart'].dt.astimezone(pytz.UTC),
+            dt.datetime(2019, 2, 7, 5, 0, tzinfo=pytz.UTC))
+
+        components = list(iter_calendar_components(ics, {'todo'}))
+        self.assertEqual([str(c['uid']) for c in components], ['todo'])
+
+    def test_component_cache_large_file(self):
+        ics = self.write_ics('event.ics', VEVENT_ALARM + VEVENT.replace(
+                'UID:20190310', 'UID:other'))
+        cache = ComponentCache(max_file_size=0)
+
+        with patch('remhind.events._parse_block',
+                wraps=remhind.events._parse_block) as parse_mock:
+            self.assertEqual(
+                cache.get_many(['other'], ics)['other']['summary'],
+                'Annual Employee Review')
+            self.assertEqual(parse_mock.call_count, 1)
+        self.assertEqual(cache._cache, {})
+
+
+class TestAsyncCalendarStore(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cal_path = pathlib.Path(tmp_dir.name)
+        self.store = await AsyncCalendarStore.open(
+            [{'name': 'Test', 'path': str(self.cal_path)}],
+            self.cal_path / 'remhind.db', workers=1)
+        self.addAsyncCleanup(self.store.close)
+
+    async def test_store_thread(self):
+        threads = {}
+
+        def record_thread(name, func):
+            def wrapper(*args):
+                threads.setdefault(name, set()).add(threading.get_ident())
+                return func(*args)
+            return wrapper
+
+        store = self.store.store
+        ics = self.cal_path / 'event.ics'
+        ics.write_text('BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:remhind\n'
+            + VEVENT_ALARM.strip() + '\nEND:VCALENDAR\n')
+        with patch.object(store, 'scan_file',
+                record_thread('scan', store.scan_file)), patch.object(
+                store, 'parse_file',
+                record_thread('parse', store.parse_file)), patch.object(
+                store, 'index_file',
+                record_thread('index', store.index_file)):
+            await self.store.sync_file(ics)
+            await self.store.sync_file(ics)
+        self.assertEqual(threads['scan'], threads['index'])
+        self.assertEqual(len(threads['index']), 1)
+        self.assertEqual(len(threads['parse']), 1)
+        self.assertNotEqual(threads['parse'], threads['index'])
+        self.assertNotIn(threading.get_ident(), threads['index'])
+        self.assertNotIn(threading.get_ident(), threads['parse'])
+
+        start = dt.datetime(2019, 3, 10, 14, 30, tzinfo=pytz.UTC)
+        alarms = await self.store.get_due_alarms(start)
+        self.assertEqual(
+            [a.message for a in alarms], ['Breakfast Meeting Reminder'])
+        self.assertEqual(
+            await self.store.get_next_alarm_date(start),
+            start.astimezone(remhind.events.LOCAL_TZ))
+
+    async def test_index_invalid_file(self):
+        invalid_ics = self.cal_path / 'invalid.ics'
+        invalid_ics.write_text('BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:remhind\n'
+            + VEVENT_ALARM.replace('ACTION:DISPLAY\n', '').strip()
+            + '\nEND:VCALENDAR\n')
+        ics = self.cal_path / 'event.ics'
+        ics.write_text(invalid_ics.read_text().replace(
+                'UID:20190310', 'UID:other').replace(
+                'TRIGGER', 'ACTION:DISPLAY\nTRIGGER'))
+        with self.assertLogs(level='ERROR'):
+            await self.store.rescan()
+
+        db = self.store.store.events.db
+        self.assertEqual(await self.store.run(db.get_uids, ics), {'other'})
+        self.assertIsNone(
+            await self.store.run(db.get_fingerprint, invalid_ics))
+
+    async def test_alarms_during_parsing(self):
+        parsing, release = threading.Event(), threading.Event()
+        store = self.store.store
+        parse_file = store.parse_file
+
+        def blocking_parse_file(*args):
+            parsing.set()
+            release.wait(5)
+            return parse_file(*args)
+
+        ics = self.cal_path / 'event.ics'
+        ics.write_text('BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:remhind\n'
+            + VEVENT_ALARM.strip() + '\nEND:VCALENDAR\n')
+        start = dt.datetime(2019, 3, 10, 14, 30, tzinfo=pytz.UTC)
+        with patch.object(store, 'parse_file', blocking_parse_file):
+            sync = asyncio.create_task(self.store.sync_file(ics))
+            await asyncio.get_running_loop().run_in_executor(
+                None, parsing.wait, 5)
+            alarms = await asyncio.wait_for(
+                self.store.get_due_alarms(start), 1)
+            self.assertEqual(alarms, [])
+            release.set()
+            await sync
+        alarms = await self.store.get_due_alarms(start)
+        self.assertEqual(
+            [a.message for a in alarms], ['Breakfast Meeting Reminder'])
+
+
+class TestCheckEvents(unittest.IsolatedAsyncioTestCase):
+
+    async def test_skipped_minutes(self):
+        store = AsyncMock(listeners=[])
+        store.get_due_alarms_by_minute.return_value = []
+        store.get_next_alarm_date.return_value = None
+        notifier = Mock()
+        first, second = Mock(), Mock()
+
+        def utc(hour, minute):
+            return dt.datetime(2019, 3, 10, hour, minute, tzinfo=pytz.UTC)
+
+        async def check(tick, alarms=()):
+            store.reset_mock()
+            notifier.reset_mock()
+            store.get_due_alarms_by_minute.return_value = alarms
+            frozen.tick(tick)
+            store.listeners[0]()
+            await asyncio.sleep(0.1)
+
+        with freeze_time('2019-03-10 12:00:30', real_asyncio=True) as frozen:
+            task = asyncio.create_task(check_events(store, notifier))
+            self.addCleanup(task.cancel)
+            await asyncio.sleep(0.1)
+            store.get_due_alarms_by_minute.assert_called_once_with(
+                utc(12, 0), utc(12, 1))
+
+            # The storage thread was busy for a few minutes
+            await check(dt.timedelta(minutes=3), [[first], [], [second]])
+            store.get_due_alarms_by_minute.assert_called_once_with(
+                utc(12, 1), utc(12, 4))
+            store.renew_stale_events.assert_not_called()
+            # The alarms of each minute are notified apart
+            self.assertEqual(
+                notifier.notify.call_args_list,
+                [call([first]), call([]), call([second])])
+
+            await check(dt.timedelta(days=2))
+            store.get_due_alarms_by_minute.assert_called_once_with(
+                utc(12, 3) + dt.timedelta(days=2),
+                utc(12, 4) + dt.timedelta(days=2))
+            store.renew_stale_events.assert_called_once_with(
+                utc(12, 3) + dt.timedelta(days=2))
@@ -0,0 +1,175 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+from unittest.mock import AsyncMock
+
+from ..monitor import CalendarWatcher, monitor_calendars
+
+
+class TestMonitorCalendars(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cal_path = pathlib.Path(tmp_dir.name)
+        self.store = AsyncMock()
+        self.monitor = asyncio.create_task(monitor_calendars(
+                {'test': {'path': str(self.cal_path)}}, self.store,
+                quiet_period=0.2))
+        self.addAsyncCleanup(self.stop_monitor)
+        await asyncio.sleep(0.1)
+
+    async def stop_monitor(self):
+        self.monitor.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await self.monitor
+
+    async def test_coalesce_events(self):
+        ics = self.cal_path / 'event.ics'
+        for idx in range(5):
+            with ics.open('a') as fd:
+                fd.write(f'line {idx}\n')
+            await asyncio.sleep(0.05)
+        (self.cal_path / 'ignored.txt').write_text('ignored')
+        await asyncio.sleep(0.5)
+
+        self.store.sync_file.assert_called_once_with(ics)
+
+    async def test_separate_files(self):
+        for name in ['first.ics', 'second.ics']:
+            (self.cal_path / name).write_text('content')
+        (self.cal_path / 'first.ics').unlink()
+        await asyncio.sleep(0.5)
+
+        self.assertEqual(
+            sorted(
+                c.args[0].name for c in self.store.sync_file.call_args_list),
+            ['first.ics', 'second.ics'])
+
+    async def test_single_watcher(self):
+        other_path = self.cal_path / 'other'
+        other_path.mkdir()
+        await self.stop_monitor()
+        self.monitor = asyncio.create_task(monitor_calendars(
+                {
+                    'test': {'path': str(self.cal_path)},
+                    'duplicate': {'path': str(self.cal_path)},
+                    'other': {'path': str(other_path)},
+                    }, self.store, quiet_period=0.2))
+        await asyncio.sleep(0.1)
+
+        (self.cal_path / 'event.ics').write_text('content')
+        (other_path / 'event.ics').write_text('content')
+        await asyncio.sleep(0.5)
+
+        self.assertEqual(
+            sorted(c.args[0] for c in self.store.sync_file.call_args_list),
+            [self.cal_path / 'event.ics', other_path / 'event.ics'])
+
+    async def test_reload_config(self):
+        first_path = self.cal_path / 'first'
+        second_path = self.cal_path / 'second'
+        for path in [first_path, second_path]:
+            path.mkdir()
+        config_path = self.cal_path / 'config'
+        config_path.write_text(f'[calendars.first]\npath = "{first_path}"\n')
+        await self.stop_monitor()
+        self.monitor = asyncio.create_task(monitor_calendars(
+                {'first': {'path': str(first_path)}}, self.store,
+                quiet_period=0.2, config_path=config_path))
+        await asyncio.sleep(0.1)
+
+        config_path.write_text(
+            f'[calendars.second]\npath = "{second_path}"\n')
+        await asyncio.sleep(0.5)
+        self.store.set_sources.assert_called_once_with(
+            [{'path': str(second_path)}])
+
+        (first_path / 'event.ics').write_text('content')
+        (second_path / 'event.ics').write_text('content')
+        (self.cal_path / 'event.ics').write_text('content')
+        await asyncio.sleep(0.5)
+        self.store.sync_file.assert_called_once_with(
+            second_path / 'event.ics')
+
+        for content in [
+                'invalid', 'calendars = 1\n', '[calendars]\nfirst = 1\n',
+                '[calendars.first]\nname = "First"\n']:
+            with self.subTest(content=content), self.assertLogs(
+                    level='ERROR') as logs:
+                config_path.write_text(content)
+                await asyncio.sleep(0.5)
+            self.assertIn('Could not reload configuration', logs.output[0])
+        self.store.set_sources.assert_called_once()
+
+        (first_path / 'other.ics').write_text('content')
+        await asyncio.sleep(0.5)
+        self.store.sync_file.assert_called_once_with(
+            second_path / 'event.ics')
+
+    async def test_recursive(self):
+        collection_path = self.cal_path / 'collection'
+        collection_path.mkdir()
+        (self.cal_path / '.hidden').mkdir()
+        await self.stop_monitor()
+        self.monitor = asyncio.create_task(monitor_calendars(
+                {'test': {'path': str(self.cal_path), 'recursive': True}},
+                self.store, quiet_period=0.2))
+        await asyncio.sleep(0.1)
+
+        (collection_path / 'event.ics').write_text('content')
+        (self.cal_path / '.hidden' / 'event.ics').write_text('content')
+        new_path = self.cal_path / 'new' / 'nested'
+        new_path.mkdir(parents=True)
+        (self.cal_path / '.git').mkdir()
+        await asyncio.sleep(0.1)
+        (new_path / 'event.ics').write_text('content')
+        (self.cal_path / '.git' / 'event.ics').write_text('content')
+        await asyncio.sleep(0.5)
+
+        self.assertEqual(
+            sorted(c.args[0] for c in self.store.sync_file.call_args_list),
+            [collection_path / 'event.ics', new_path / 'event.ics'])
+        self.store.rescan.assert_called_once_with(self.cal_path / 'new')
+
+        self.store.reset_mock()
+        (collection_path / 'event.ics').unlink()
+        collection_path.rmdir()
+        await asyncio.sleep(0.5)
+        self.store.sync_file.assert_called_once_with(
+            collection_path / 'event.ics')
+        self.store.rescan.assert_called_once_with(collection_path)
+
+        # The watch of a removed directory is set up again on creation
+        self.store.reset_mock()
+        collection_path.mkdir()
+        await asyncio.sleep(0.1)
+        (collection_path / 'event.ics').write_text('content')
+        await asyncio.sleep(0.5)
+        self.store.sync_file.assert_called_once_with(
+            collection_path / 'event.ics')
+
+
+class TestCalendarWatcher(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cal_path = pathlib.Path(tmp_dir.name)
+        self.watcher = CalendarWatcher()
+        self.addCleanup(self.watcher.close)
+
+    def test_overlapping_calendars(self):
+        work_path = self.cal_path / 'work'
+        (work_path / 'nested').mkdir(parents=True)
+        all_calendar = {'path': str(self.cal_path), 'recursive': True}
+        self.watcher.set_calendars(
+            {'all': all_calendar, 'work': {'path': str(work_path)}})
+        self.assertTrue(self.watcher.is_recursive(str(work_path)))
+
+        self.watcher.set_calendars({'all': all_calendar})
+        self.assertEqual(
+            set(self.watcher.directories),
+            {str(self.cal_path), str(work_path), str(work_path / 'nested')})
+        self.assertIn(str(work_path), self.watcher.watcher.requests)
@@ -0,0 +1,92 @@
+import datetime as dt
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+import pytz
+
+from ..db import Alarm
+from ..notify import Notifier
+
+
+def make_alarms(count):
+    due = dt.datetime(2019, 3, 10, 15, 0, tzinfo=pytz.UTC).timestamp()
+    return [Alarm(idx, f'event{idx}', f'Alarm {idx}', due, due)
+        for idx in range(count)]
+
+
+class TestNotifier(unittest.TestCase):
+
+    def notifier(self, **kwargs):
+        show = Mock()
+        notifier = Notifier(show=show, **kwargs)
+        notifier.start()
+        self.addCleanup(notifier.stop)
+        return notifier, show
+
+    def wait_calls(self, show, count):
+        for _ in range(100):
+            if show.call_count >= count:
+                break
+            time.sleep(0.01)
+
+    def test_single_alarms(self):
+        notifier, show = self.notifier(group_threshold=3, max_rate=0)
+        notifier.notify(make_alarms(3))
+        self.wait_calls(show, 3)
+
+        self.assertEqual(
+            [c.args[1] for c in show.call_args_list], ['Alarm'] * 3)
+        self.assertEqual(
+            [c.args[0].split(' ', 1)[1] for c in show.call_args_list],
+            ['Alarm 0', 'Alarm 1', 'Alarm 2'])
+
+    def test_grouped_alarms(self):
+        notifier, show = self.notifier(group_threshold=3, max_rate=0)
+        notifier.notify(make_alarms(12))
+        self.wait_calls(show, 1)
+        time.sleep(0.05)
+
+        show.assert_called_once()
+        summary, body = show.call_args.args
+        self.assertEqual(summary, '12 alarms')
+        lines = body.splitlines()
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[-1], 'and 2 more')
+
+        notifier.group_threshold = 0
+        notifier.notify(make_alarms(12))
+        self.wait_calls(show, 13)
+        self.assertEqual(show.call_count, 13)
+
+    def test_rate_limit(self):
+        notifier, show = self.notifier(group_threshold=0, max_rate=20)
+        start = time.monotonic()
+        notifier.notify(make_alarms(5))
+        self.wait_calls(show, 5)
+
+        self.assertEqual(show.call_count, 5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_bounded_queue(self):
+        blocked = threading.Event()
+        notifier, show = self.notifier(
+            group_threshold=0, max_rate=0, queue_size=2)
+        show.side_effect = lambda *args: blocked.wait(1)
+
+        notifier.notify(make_alarms(10))
+        blocked.set()
+        self.wait_calls(show, 3)
+        time.sleep(0.05)
+        # One message is being shown while two are queued
+        self.assertLessEqual(show.call_count, 3)
+
+    def test_stop_discards_pending(self):
+        notifier, show = self.notifier(group_threshold=0, max_rate=1)
+        notifier.notify(make_alarms(10))
+        start = time.monotonic()
+        notifier.stop()
+
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLessEqual(show.call_count, 1)
@@ -0,0 +1,77 @@
+import pathlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ..db import SQLiteDB
+from ..stats import Stats, STATS
+
+
+class TestStats(unittest.TestCase):
+
+    def test_disabled(self):
+        stats = Stats()
+
+        @stats.timed('func')
+        def func():
+            return 42
+
+        self.assertEqual(func(), 42)
+        with stats.timer('block'):
+            pass
+        stats.increment('counter')
+        self.assertEqual(stats.histograms, {})
+        self.assertEqual(stats.counters, {})
+
+    def test_enabled(self):
+        stats = Stats()
+        stats.enabled = True
+
+        @stats.timed('func')
+        def func():
+            raise ValueError
+
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                func()
+        with stats.timer('block'):
+            pass
+        stats.increment('counter', 2)
+
+        self.assertEqual(stats.histograms['func'].count, 3)
+        self.assertEqual(stats.histograms['block'].count, 1)
+        self.assertEqual(stats.counters, {'counter': 2})
+        self.assertEqual(
+            [line.split(':')[0] for line in stats.summary()],
+            ['block', 'func', 'counter'])
+
+    def test_metrics(self):
+        stats = Stats()
+        stats.enabled = True
+        for duration in [0.00005, 0.003, 0.003, 20]:
+            stats.record('db.query', duration)
+        stats.increment('notifications')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / 'metrics.prom'
+            stats.write_metrics(path)
+            lines = path.read_text().splitlines()
+            self.assertEqual(list(pathlib.Path(tmp_dir).iterdir()), [path])
+
+        self.assertIn('# TYPE remhind_db_query_seconds histogram', lines)
+        self.assertIn('remhind_db_query_seconds_bucket{le="0.0001"} 1', lines)
+        self.assertIn('remhind_db_query_seconds_bucket{le="0.005"} 3', lines)
+        self.assertIn('remhind_db_query_seconds_bucket{le="10"} 3', lines)
+        self.assertIn('remhind_db_query_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('remhind_db_query_seconds_count 4', lines)
+        self.assertIn('remhind_notifications_total 1', lines)
+
+    def test_instrumented_queries(self):
+        db = SQLiteDB()
+        with patch.object(STATS, 'enabled', True):
+            STATS.reset()
+            self.addCleanup(STATS.reset)
+            db.get_uids('/tmp/calendar.ics')
+            db.get_uids('/tmp/other.ics')
+
+        self.assertEqual(STATS.histograms['db.get_uids'].count, 2)